@@ -0,0 +1,280 @@
+#!/usr/bin/env python3.4
+#
+# CPU benchmarks for the training, completion and post-processing hot
+# paths. Every case builds DCGAN with random weights and runs in its own
+# process for each of its parameter sets, so that their peak memory is
+# measured in isolation. Results made in one process share its peak: the
+# uncached and cached blends of one batch size, and the merge and
+# save_images of one grid. The results are written as one JSON document
+# that can be compared across commits.
+
+from __future__ import division
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+from argparse import Namespace
+
+import numpy as np
+
+# Keep TensorFlow on the CPU; it is imported by the cases themselves so
+# that every case starts from a fresh process.
+os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+FORMAT_VERSION = 2
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--out', type=str, default=None,
+                    help='Write the JSON results here instead of stdout.')
+parser.add_argument('--cases', type=str, nargs='*',
+                    choices=['train', 'complete', 'calc_mask', 'blending', 'save_images'],
+                    default=['train', 'complete', 'calc_mask', 'blending', 'save_images'])
+parser.add_argument('--trainSteps', type=int, default=10)
+parser.add_argument('--trainTowers', type=int, nargs='+', default=[1],
+                    help='Numbers of CPU towers to split training batches across.')
+parser.add_argument('--completeSteps', type=int, default=20)
+parser.add_argument('--batchSizes', type=int, nargs='+', default=[16, 64])
+parser.add_argument('--blendBatchSizes', type=int, nargs='+', default=[1, 64])
+parser.add_argument('--maskTypes', type=str, nargs='+', default=['center', 'random', 'Eye'])
+parser.add_argument('--repeats', type=int, default=5)
+
+
+def session(cpus=1):
+    import tensorflow as tf
+    return tf.Session(config=tf.ConfigProto(device_count={'GPU': 0, 'CPU': cpus}))
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def random_images(n, image_size=64):
+    return np.random.uniform(-1, 1, size=(n, image_size, image_size, 3)).astype(np.float32)
+
+
+def bench_train(args):
+    """Training steps per second over a folder of synthetic PNGs, for
+    every number of towers in `args.trainTowers`.
+
+    The towers are logical CPU devices of one process. They share its
+    intra-op thread pool, so they can only add inter-op parallelism.
+    """
+    import tensorflow as tf
+    from model import DCGAN
+    from utils import save_images
+
+    batch_size = 64
+    results = []
+    workdir = tempfile.mkdtemp()
+    try:
+        dataset = os.path.join(workdir, 'data')
+        os.makedirs(dataset)
+        os.makedirs(os.path.join(workdir, 'samples'))
+        for i, image in enumerate(random_images(batch_size*args.trainSteps)):
+            save_images(image[np.newaxis], [1, 1], os.path.join(dataset, '%06d.png' % i))
+
+        for towers in args.trainTowers:
+            timings = os.path.join(workdir, 'timings_%d.json' % towers)
+            config = Namespace(dataset=dataset, dataset_cache=None, epoch=1,
+                               train_size=batch_size*args.trainSteps, batch_size=batch_size,
+                               learning_rate=0.0002, beta1=0.5,
+                               checkpoint_dir=os.path.join(workdir, 'checkpoint_%d' % towers),
+                               prefetch=8, loaders=4, d_steps=1, g_steps=2,
+                               log_interval=args.trainSteps+1, timings=timings,
+                               trace_steps='', trace_dir=workdir,
+                               sample_interval=0, checkpoint_interval=0,
+                               keep_checkpoints=3, milestone_interval=0)
+            devices = ['/cpu:%d' % i for i in range(towers)] if towers > 1 else None
+            # train() writes its samples and logs relative to the cwd.
+            cwd = os.getcwd()
+            os.chdir(workdir)
+            try:
+                with tf.Graph().as_default(), session(towers) as sess:
+                    dcgan = DCGAN(sess, batch_size=batch_size,
+                                  checkpoint_dir=config.checkpoint_dir, devices=devices)
+                    dcgan.train(config)
+            finally:
+                os.chdir(cwd)
+
+            # The first step pays for graph warm-up, and the last wait on
+            # the loader only sees the end of the epoch.
+            seconds = 0.0
+            loads = []
+            with open(timings) as f:
+                for line in f:
+                    record = json.loads(line)
+                    if record.get('phase') == 'load':
+                        loads.append(record['seconds'])
+                    elif record.get('phase') in ('d_step', 'g_step', 'summary') \
+                            and record['step'] > 1:
+                        seconds += record['seconds']
+            seconds += sum(loads[1:-1])
+            steps = args.trainSteps - 1
+            results.append({'name': 'train',
+                            'params': {'batch_size': batch_size, 'steps': steps,
+                                       'towers': towers},
+                            'unit': 'steps/s', 'value': steps / seconds, 'seconds': seconds})
+    finally:
+        shutil.rmtree(workdir)
+    return results
+
+
+def bench_complete(args):
+    """z optimization iterations per second for every batch size and mask."""
+    import tensorflow as tf
+    from model import DCGAN
+
+    results = []
+    for batch_size in args.batchSizes:
+        with tf.Graph().as_default(), session() as sess:
+            dcgan = DCGAN(sess, batch_size=batch_size, mode='complete')
+            dcgan.build_latent_optimizer(0, 0.01)
+            tf.initialize_all_variables().run()
+            for maskType in args.maskTypes:
+                mask = np.resize(dcgan.make_mask(maskType), [batch_size] + dcgan.image_shape)
+                sess.run(dcgan.z_fill, feed_dict={
+                    dcgan.z_slots: range(batch_size),
+                    dcgan.zhat_in: np.random.uniform(-1, 1, size=(batch_size, dcgan.z_dim))})
+                fd = {dcgan.mask: mask, dcgan.images: random_images(batch_size)}
+                sess.run(dcgan.z_step, feed_dict=fd)
+                start = time.time()
+                for i in range(args.completeSteps):
+                    sess.run(dcgan.z_step, feed_dict=fd)
+                seconds = time.time() - start
+                results.append({
+                    'name': 'complete',
+                    'params': {'batch_size': batch_size, 'maskType': maskType,
+                               'steps': args.completeSteps},
+                    'unit': 'iterations/s', 'value': args.completeSteps / seconds,
+                    'seconds': seconds})
+    return results
+
+
+def bench_calc_mask(args):
+    """Mask estimation for one batch of 64 images."""
+    from postprocess import estimate_masks
+
+    config = Namespace(threshold=0.85, closeDisk=5, openDisk=4)
+    y = 255*np.random.rand(64, 64, 64, 3)
+    x = 255*np.random.rand(64, 64, 64, 3)
+    start = time.time()
+    for i in range(args.repeats):
+        estimate_masks(y, x, config)
+    seconds = (time.time() - start) / args.repeats
+    return [{'name': 'calc_mask', 'params': {'batch_size': 64},
+             'unit': 's/batch', 'value': seconds, 'seconds': seconds*args.repeats}]
+
+
+def bench_blending(args):
+    """Poisson blending per image, with and without a cached factorization."""
+    from postprocess import poisson_blend, poisson_systems
+
+    results = []
+    # The hole of the 'center' completion mask.
+    mask = np.zeros((64, 64))
+    mask[16:48, 16:48] = 1.0
+    for batch_size in args.blendBatchSizes:
+        source = random_images(batch_size)
+        target = random_images(batch_size)
+        for cached in [False, True]:
+            seconds = 0.0
+            for i in range(args.repeats):
+                if not cached:
+                    poisson_systems.data.clear()
+                start = time.time()
+                poisson_blend(source, target, mask)
+                seconds += time.time() - start
+            results.append({
+                'name': 'blending',
+                'params': {'batch_size': batch_size, 'cached': cached},
+                'unit': 's/image', 'value': seconds / (args.repeats*batch_size),
+                'seconds': seconds})
+    return results
+
+
+def bench_save_images(args):
+    """Grid assembly and PNG encoding of an 8x8 sheet."""
+    from utils import merge, save_images, inverse_transform
+
+    images = random_images(64)
+    workdir = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        for i in range(args.repeats):
+            merge(inverse_transform(images), [8, 8])
+        merge_seconds = time.time() - start
+        start = time.time()
+        for i in range(args.repeats):
+            save_images(images, [8, 8], os.path.join(workdir, '%d.png' % i))
+        save_seconds = time.time() - start
+    finally:
+        shutil.rmtree(workdir)
+    return [{'name': 'merge', 'params': {'grid': [8, 8]}, 'unit': 's/grid',
+             'value': merge_seconds / args.repeats, 'seconds': merge_seconds},
+            {'name': 'save_images', 'params': {'grid': [8, 8]}, 'unit': 's/grid',
+             'value': save_seconds / args.repeats, 'seconds': save_seconds}]
+
+
+CASES = {
+    'train': bench_train,
+    'complete': bench_complete,
+    'calc_mask': bench_calc_mask,
+    'blending': bench_blending,
+    'save_images': bench_save_images,
+}
+
+def split_case(name, args):
+    """Returns a copy of `args` for every process that case `name` runs in."""
+    sweeps = {'train': 'trainTowers', 'complete': 'batchSizes',
+              'blending': 'blendBatchSizes'}
+    if name not in sweeps:
+        return [args]
+    return [Namespace(**dict(vars(args), **{sweeps[name]: [value]}))
+            for value in getattr(args, sweeps[name])]
+
+def run_case(name, args):
+    results = CASES[name](args)
+    peak = peak_rss_mb()
+    for result in results:
+        result['peak_rss_mb'] = peak
+    return results
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    report = {
+        'format': FORMAT_VERSION,
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'host': {'machine': platform.machine(), 'python': platform.python_version(),
+                 'cpus': multiprocessing.cpu_count()},
+        'results': [],
+    }
+    for name in args.cases:
+        # A fresh process per parameter set keeps peak memory numbers separate.
+        for case_args in split_case(name, args):
+            pool = multiprocessing.Pool(1)
+            try:
+                report['results'].extend(pool.apply(run_case, (name, case_args)))
+            finally:
+                pool.close()
+                pool.join()
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
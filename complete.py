@@ -6,9 +6,9 @@
 
 import argparse
 import os
-import tensorflow as tf
+import multiprocessing
+from six.moves import queue
 
-from model import DCGAN
 parser = argparse.ArgumentParser()
 parser.add_argument('--lr', type=float, default=0.01)
 parser.add_argument('--momentum', type=float, default=0.9)
@@ -18,9 +18,13 @@ parser.add_argument('--lam', type=float, default=0.1)
 parser.add_argument('--checkpointDir', type=str, default='checkpoint')
 parser.add_argument('--outDir', type=str, default='completions')
 parser.add_argument('--maskType', type=str,
-                    choices=['random', 'center', 'left', 'full', 'Eye'],
+                    choices=['random', 'center', 'left', 'full', 'Eye', 'Scarf'],
                     default='center')
-parser.add_argument('imgs', type=str, nargs='+')
+parser.add_argument('imgs', type=str, nargs='*')
+parser.add_argument('--prefetch', type=int, default=2,
+                    help='Number of input batches decoded ahead of the optimizer.')
+parser.add_argument('--cache', type=str, default=None,
+                    help='Dataset written by ingest-images.py to read inputs from.')
 
 ### new args added by Yu-An Chen and Wei-Che Chen
 parser.add_argument('--maskIter', type=int, default=0)
@@ -29,15 +33,90 @@ parser.add_argument('--loss', type=int, default=0)
 parser.add_argument('--closeDisk',type=int, default=5)
 parser.add_argument('--openDisk',type=int, default=4)
 parser.add_argument('--threshold',type=float, default=0.85)
+parser.add_argument('--stepsPerRun', type=int, default=1,
+                    help='Number of z optimization steps per session run.')
+parser.add_argument('--blend', action='store_true',
+                    help='Poisson-blend the generated region into the input.')
+parser.add_argument('--workers', type=int, default=0,
+                    help='Processes for mask estimation and blending (0 runs them inline).')
+parser.add_argument('--patience', type=int, default=0,
+                    help='Stop an image after this many iterations without improvement (0 disables).')
+parser.add_argument('--tol', type=float, default=1e-3,
+                    help='Relative loss decrease that counts as an improvement.')
+parser.add_argument('--timings', type=str, default=None,
+                    help='File to append per-phase timings to, as JSON lines.')
+parser.add_argument('--traceSteps', type=int, nargs='*', default=[],
+                    help='Optimizer steps to capture a TensorFlow trace for.')
+parser.add_argument('--snapshots', type=int, default=None,
+                    help='Steps between snapshot grids and per-round mask files '
+                    '(0 disables; default 50, or 0 with --serve).')
+parser.add_argument('--archive', type=str, default=None,
+                    help='Append results to this archive in outDir instead of writing PNGs.')
+parser.add_argument('--restarts', type=int, default=1,
+                    help='Random z initializations optimized per image; the best one is kept.')
+parser.add_argument('--pruneAfter', type=int, default=0,
+                    help='Iteration at which all but the best --keepRestarts restarts stop (0 disables).')
+parser.add_argument('--keepRestarts', type=int, default=1)
+parser.add_argument('--latentCache', type=str, default=None,
+                    help='Directory of optimized z vectors used to warm-start repeated images.')
+parser.add_argument('--latentCacheSize', type=int, default=100000,
+                    help='Maximum number of cached z vectors.')
+parser.add_argument('--warmIter', type=int, default=100,
+                    help='Iterations for images warm-started from the cache or encoder, '
+                    'at most --nIter (0 uses --nIter).')
+parser.add_argument('--encoderDir', type=str, default=None,
+                    help='Encoder checkpoint from train-encoder.py; its z estimate starts the first restart.')
+parser.add_argument('--frozen', type=str, default=None,
+                    help='Completion graph from export-completion.py to use instead of the checkpoint.')
+parser.add_argument('--numpyWeights', type=str, default=None,
+                    help='Weights from export-numpy.py; completes with NumPy, without TensorFlow.')
+parser.add_argument('--serve', type=str, default=None,
+                    help='Keep running and complete images POSTed to HOST:PORT or unix:PATH; '
+                    'a POST to /shutdown stops it.')
+parser.add_argument('--maxWait', type=float, default=0.05,
+                    help='Seconds an idle server waits to gather a batch of requests.')
 args = parser.parse_args()
 
-assert(os.path.exists(args.checkpointDir))
+assert(args.frozen is not None or args.numpyWeights is not None or
+       os.path.exists(args.checkpointDir))
+assert(args.numpyWeights is None or (args.encoderDir is None and args.frozen is None))
+assert(args.imgs or args.serve)
+# A resident server only writes snapshots when asked to.
+if args.snapshots is None:
+    args.snapshots = 0 if args.serve else 50
 
-os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
-config = tf.ConfigProto()
-config.gpu_options.allow_growth = False
-config.gpu_options.per_process_gpu_memory_fraction=0.5
-with tf.Session(config=config) as sess:
-    dcgan = DCGAN(sess, image_size=args.imgSize,
-                  checkpoint_dir=args.checkpointDir, lam=args.lam)
-    dcgan.complete(args)
+# The pool is forked before TensorFlow is imported, and its workers
+# only run postprocess.py, which does not import it either. With
+# --numpyWeights, TensorFlow is not imported at all.
+pool = multiprocessing.Pool(args.workers) if args.workers > 0 else None
+
+from server import start_server
+
+def run(completer):
+    if args.serve:
+        requests = queue.Queue()
+        start_server(args.serve, completer, requests, args.maskType)
+        completer.serve(args, requests, pool=pool)
+    else:
+        completer.complete(args, pool=pool)
+
+if args.numpyWeights is not None:
+    from completion import NumpyCompletion
+    run(NumpyCompletion(args.numpyWeights, image_size=args.imgSize, lam=args.lam))
+else:
+    import tensorflow as tf
+
+    from model import DCGAN
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = False
+    config.gpu_options.per_process_gpu_memory_fraction=0.5
+    with tf.Session(config=config) as sess:
+        run(DCGAN(sess, image_size=args.imgSize,
+                  checkpoint_dir=args.checkpointDir, lam=args.lam, mode='complete',
+                  encoder=args.encoderDir is not None, frozen=args.frozen))
+
+if pool is not None:
+    pool.close()
+    pool.join()
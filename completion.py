@@ -0,0 +1,470 @@
+# The job loop of image completion, shared by `DCGAN`, which optimizes
+# z in a TensorFlow session, and `NumpyCompletion`, which optimizes it
+# with numpy_model.py. This module does not import TensorFlow, so
+# complete.py can run `NumpyCompletion` on machines without it.
+
+from __future__ import division
+import os
+import time
+
+import numpy as np
+from six.moves import xrange, queue
+
+from numpy_model import NumpyDCGAN, load_weights
+from postprocess import finish_round
+from utils import (ImageCache, ImageWriter, LatentCache, PhaseTimer,
+                   ResultArchive, checkpoint_id, get_image, image_key, prefetch)
+
+
+class Completion(object):
+    """Completes images by optimizing z in a batch of slots.
+
+    Subclasses set `image_size`, `image_shape`, `batch_size`, `z_dim`,
+    `is_crop`, `use_encoder` and `checkpoint_id`, and implement
+    `prepare_completion(config, nSlots)`, which returns the number of
+    slots, `fill_z(slots, zhats)`, which starts the given slots from
+    `zhats` with fresh optimizer state, `run_z_step(images, mask, timer,
+    step)`, which runs `config.stepsPerRun` updates of every slot and
+    returns the per-slot loss and G(z) before the last update and the
+    updated z, and, if `use_encoder` is set, `encode_z(images, masks)`.
+    """
+    def make_output_dirs(self, outDir):
+        for subdir in ['hats_imgs', 'completed', 'mask', 'results']:
+            path = os.path.join(outDir, subdir)
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+    def complete(self, config, pool=None):
+        #####################################################
+        # This function was modified by Yu-An Chen and Wei-Che Chen
+        #####################################################
+        self.make_output_dirs(config.outDir)
+        # Small jobs get fewer slots instead of zero-padded ones.
+        nSlots = self.prepare_completion(
+            config, min(self.batch_size, len(config.imgs)*config.restarts))
+
+        # Optimized z of earlier runs on the same images and checkpoint.
+        latents = None
+        if config.latentCache:
+            latents = LatentCache(config.latentCache, self.checkpoint_id,
+                                  config.latentCacheSize)
+
+        mask = self.make_mask(config.maskType)
+        timer = PhaseTimer(config.timings, config.traceSteps, config.outDir)
+        # PNG encoding and disk writes happen off the optimizer loop.
+        writer = ImageWriter()
+        # With an archive, results are appended to it instead of
+        # being written as one PNG per image.
+        archive = None
+        if config.archive:
+            archive = ResultArchive(os.path.join(config.outDir, config.archive),
+                                    self.image_shape, self.z_dim)
+
+        # The next images are decoded on a background thread while the
+        # current ones are being optimized.
+        cache = ImageCache(config.cache) if config.cache else None
+        if cache is not None:
+            assert(cache.image_size == self.image_size)
+            assert(cache.is_crop == self.is_crop)
+        batches = prefetch(self.image_batches(config.imgs, cache), config.prefetch)
+        inputs = ((batch_file, image)
+                  for batch_files, batch_images in batches
+                  for batch_file, image in zip(batch_files, batch_images))
+        # Outputs are named by the input's position as well, since
+        # inputs from different directories can share a file name.
+        pending = (self.new_job(batch_file, image, mask, '{:06d}_{}'.format(
+                       i, os.path.splitext(os.path.basename(batch_file))[0]))
+                   for i, (batch_file, image) in enumerate(inputs))
+
+        def finish(job):
+            if archive is not None:
+                archive.append(job['file'], job['completed'], job['mask'][:,:,0],
+                               job['z'], job['loss'])
+            if latents is not None:
+                latents.put(job['key'], job['z'])
+
+        self.run_jobs(config, nSlots, lambda idle: next(pending, None), finish,
+                      pool, timer, writer, latents)
+        with timer.phase('flush'):
+            writer.flush()
+            if archive is not None:
+                archive.close()
+        timer.close()
+
+    def serve(self, config, requests, pool=None):
+        """Completes the requests put on the `requests` queue until it gets None.
+
+        A request has an `image`, a three-channel `mask` and a
+        `finish(job)` method that is called with its finished job, which
+        holds the result as `job['completed']`. New requests take free
+        slots as soon as they arrive. A request that arrives while the
+        optimizer is idle starts a batch after `config.maxWait` seconds,
+        or as soon as every slot is taken. The None that ends serving
+        is remembered, and serving stops once the jobs in progress are
+        done.
+        """
+        self.make_output_dirs(config.outDir)
+        nSlots = self.prepare_completion(config, self.batch_size)
+        latents = None
+        if config.latentCache:
+            latents = LatentCache(config.latentCache, self.checkpoint_id,
+                                  config.latentCacheSize)
+        timer = PhaseTimer(config.timings, config.traceSteps, config.outDir)
+        writer = ImageWriter()
+        # Requests being completed, by the id their jobs carry.
+        waiting = {}
+        state = {'count': 0, 'deadline': None, 'stop': False}
+        # Files of a run do not overwrite those of earlier runs.
+        prefix = time.strftime('request_%Y%m%d-%H%M%S')
+
+        def next_job(idle):
+            if state['stop']:
+                return None
+            try:
+                if idle:
+                    request = requests.get()
+                    state['deadline'] = time.time() + config.maxWait
+                elif state['deadline'] is not None and state['deadline'] > time.time():
+                    request = requests.get(timeout=state['deadline'] - time.time())
+                else:
+                    request = requests.get_nowait()
+            except queue.Empty:
+                state['deadline'] = None
+                return None
+            if request is None:
+                state['stop'] = True
+                return None
+            state['count'] += 1
+            job = self.new_job('{}_{:06d}.png'.format(prefix, state['count']),
+                               request.image, request.mask)
+            job['request'] = state['count']
+            waiting[state['count']] = request
+            return job
+
+        def finish(job):
+            if latents is not None:
+                latents.put(job['key'], job['z'])
+            waiting.pop(job['request']).finish(job)
+
+        print(" [*] Serving completions with %d slots" % nSlots)
+        self.run_jobs(config, nSlots, next_job, finish, pool, timer, writer, latents)
+        with timer.phase('flush'):
+            writer.flush()
+        timer.close()
+
+    def run_jobs(self, config, nSlots, next_job, finish, pool=None, timer=None,
+                 writer=None, latents=None):
+        """Optimizes image jobs in `nSlots` slots until there are no more.
+
+        `next_job(idle)` returns the next new job, or None if there is
+        none; `idle` is True when nothing else is in progress, and None
+        then ends the loop. Every job that is done after its last mask
+        round is passed to `finish`.
+        """
+        timer = timer if timer is not None else PhaseTimer()
+        # Jobs waiting for another mask round go before new images.
+        retry = []
+        # Rounds being post-processed by `pool` while the optimizer runs.
+        outstanding = []
+        nRounds = max(config.maskIter, 1)
+
+        # Every slot of the batch holds one restart of an image job.
+        # Slots are refilled as soon as their restart finishes, so the
+        # batch stays full.
+        restarts = []
+        slots = [None]*nSlots
+        batch_images = np.zeros([nSlots] + self.image_shape, np.float32)
+        batch_mask = np.zeros([nSlots] + self.image_shape, np.float32)
+        nDone = 0
+        step = 0
+        while True:
+            fill = []
+            with timer.phase('load', step=step):
+                for s in xrange(nSlots):
+                    if slots[s] is None:
+                        if not restarts:
+                            idle = not outstanding and all(slot is None for slot in slots)
+                            job = retry.pop(0) if retry else next_job(idle)
+                            if job is None:
+                                break
+                            restarts = self.restart_jobs(job, config.restarts)
+                        job = restarts.pop(0)
+                        slots[s] = job
+                        batch_images[s] = job['image']
+                        batch_mask[s] = job['mask']
+                        fill.append(s)
+            if fill:
+                self.fill_z(fill, self.initial_z(config, [slots[s] for s in fill], latents))
+
+            active = [s for s in xrange(nSlots) if slots[s] is not None]
+            if not active:
+                if not outstanding:
+                    break
+                # Nothing left to optimize until a round comes back.
+                with timer.phase('wait', step=step):
+                    result = outstanding.pop(0).get()
+                nDone += self.collect_jobs(result, retry, nRounds, finish, timer)
+                continue
+
+            with timer.phase('z_step', step=step):
+                loss, G_imgs, zhats = self.run_z_step(batch_images, batch_mask,
+                                                      timer, step)
+
+            finished = []
+            for s in active:
+                if self.update_job(config, slots[s], loss[s]):
+                    slots[s]['G'] = G_imgs[s]
+                    slots[s]['z'] = zhats[s]
+                    job = self.best_restart(slots[s])
+                    if job is not None:
+                        finished.append(job)
+                    slots[s] = None
+            if finished:
+                if pool is None:
+                    result = finish_round(config, finished, writer)
+                    nDone += self.collect_jobs(result, retry, nRounds, finish, timer)
+                else:
+                    outstanding.append(pool.apply_async(finish_round, (config, finished)))
+            while outstanding and outstanding[0].ready():
+                nDone += self.collect_jobs(outstanding.pop(0).get(), retry, nRounds,
+                                           finish, timer)
+
+            if step % 50 == 0:
+                print("Val_loss=", step*config.stepsPerRun, np.mean(loss[active]),
+                      "active:", len(active), "done:", nDone)
+            if config.snapshots > 0 and step % config.snapshots == 0:
+                with timer.phase('save_images', step=step):
+                    nRows = np.ceil(len(active)/8)
+                    nCols = 8
+                    imgName = os.path.join(config.outDir,
+                                           'hats_imgs/{:06d}.png'.format(step))
+                    writer.save_images(G_imgs[active], [nRows,nCols], imgName)
+
+                    inv_masked_hat_images = np.multiply(G_imgs, 1.0-batch_mask)
+                    completeed = np.multiply(batch_images, batch_mask) + inv_masked_hat_images
+                    imgName = os.path.join(config.outDir,
+                                           'completed/{:06d}.png'.format(step))
+                    writer.save_images(completeed[active], [nRows,nCols], imgName)
+            step += 1
+        return nDone
+
+    def new_job(self, image_file, image, mask, name=None):
+        """Returns the completion state of one input image.
+
+        Its output files are called `name`, by default the name of
+        `image_file` without its extension.
+        """
+        if name is None:
+            name = os.path.splitext(os.path.basename(image_file))[0]
+        return {'file': image_file, 'name': name, 'image': image, 'mask': mask,
+                'round': 0, 'iter': 0, 'best': np.inf, 'bestIter': 0,
+                'key': image_key(image)}
+
+    def initial_z(self, config, jobs, latents=None):
+        """Returns the starting latent codes for `jobs`.
+
+        The first restart of an image continues from its z of the last
+        mask round, or in the first round starts from its z in `latents`
+        if there is one, or else from the encoder's estimate if it was
+        built; these warm starts run at most `config.warmIter`
+        iterations. Everything else starts from a random z.
+        """
+        zhats = np.random.uniform(-1, 1, size=(len(jobs), self.z_dim))
+        warm = []
+        encode = []
+        for ii, job in enumerate(jobs):
+            if job.get('restart', 0) != 0:
+                continue
+            if job['round'] > 0:
+                z = job['z']
+            else:
+                z = latents.get(job['key']) if latents is not None else None
+            if z is not None:
+                zhats[ii] = z
+                warm.append(ii)
+            elif self.use_encoder:
+                encode.append(ii)
+        if encode:
+            zhats[encode] = self.encode_z([jobs[ii]['image'] for ii in encode],
+                                          [jobs[ii]['mask'] for ii in encode])
+            warm += encode
+        if config.warmIter > 0:
+            for ii in warm:
+                jobs[ii]['maxIter'] = min(config.warmIter, config.nIter)
+        return zhats
+
+    def restart_jobs(self, job, nRestarts):
+        """Splits `job` into `nRestarts` jobs that start from different z.
+
+        The restarts share a group that collects their results; see
+        `best_restart`.
+        """
+        group = {'job': job, 'left': nRestarts, 'best': None, 'scores': {}}
+        return [dict(job, restart=r, group=group, iter=0, best=np.inf, bestIter=0)
+                for r in xrange(nRestarts)]
+
+    def best_restart(self, restart):
+        """Records a finished restart; returns its image job once all are in.
+
+        The image job takes the result of the restart with the lowest
+        final loss.
+        """
+        group = restart['group']
+        group['left'] -= 1
+        if group['best'] is None or restart['loss'] < group['best']['loss']:
+            group['best'] = restart
+        if group['left'] > 0:
+            return None
+        best = group['best']
+        job = group['job']
+        job.update(G=best['G'], z=best['z'], loss=best['loss'], iter=best['iter'])
+        return job
+
+    def update_job(self, config, job, loss):
+        """Records one optimizer run of `job`; returns True once it is done.
+
+        A job is done after `config.nIter` iterations (or its own
+        `maxIter`) or, with
+        `config.patience > 0`, once its loss has not improved by more
+        than a `config.tol` fraction for `config.patience` iterations.
+        With `config.pruneAfter > 0`, the restarts of an image are ranked
+        by their loss at that iteration and all but the best
+        `config.keepRestarts` are stopped.
+        """
+        job['iter'] += config.stepsPerRun
+        job['loss'] = loss
+        if loss < job['best']*(1.0-config.tol):
+            job['best'] = loss
+            job['bestIter'] = job['iter']
+        if job['iter'] >= job.get('maxIter', config.nIter):
+            return True
+        if config.pruneAfter > 0 and job['iter'] >= config.pruneAfter:
+            group = job['group']
+            group['scores'].setdefault(job['restart'], loss)
+            # Rank once every restart still running has been scored.
+            if 'keep' not in group and len(group['scores']) >= group['left']:
+                ranked = sorted(group['scores'], key=group['scores'].get)
+                group['keep'] = set(ranked[:config.keepRestarts])
+            if 'keep' in group and job['restart'] not in group['keep']:
+                return True
+        return config.patience > 0 and job['iter']-job['bestIter'] >= config.patience
+
+    def collect_jobs(self, result, retry, nRounds, finish, timer):
+        """Takes the `(jobs, records)` of `finish_round`; returns how many
+        jobs are done.
+
+        Jobs that need another mask round are queued on `retry`, and
+        those that are done are passed to `finish`. The timing records
+        go to `timer`.
+        """
+        jobs, records = result
+        for fields in records:
+            timer.record(**fields)
+        nDone = 0
+        for job in jobs:
+            if job['round'] < nRounds:
+                retry.append(job)
+            else:
+                finish(job)
+                nDone += 1
+        return nDone
+
+    def make_mask(self, maskType):
+        if maskType == 'random':
+            fraction_masked = 0.2
+            mask = np.ones(self.image_shape)
+            mask[np.random.random(self.image_shape[:2]) < fraction_masked] = 0.0
+        elif maskType == 'center':
+            scale = 0.25
+            assert(scale <= 0.5)
+            mask = np.ones(self.image_shape)
+            sz = self.image_size
+            l = int(self.image_size*scale)
+            u = int(self.image_size*(1.0-scale))
+            mask[l:u, l:u, :] = 0.0
+        elif maskType == 'left':
+            mask = np.ones(self.image_shape)
+            c = self.image_size // 2
+            mask[:,:c,:] = 0.0
+        elif maskType == 'full':
+            mask = np.ones(self.image_shape)
+        elif maskType == 'Eye':
+            mask = np.ones(self.image_shape)
+            mask[:26,:,:] = 0
+        elif maskType == 'Scarf':
+            mask = np.ones(self.image_shape)
+            mask[25:,:,:] = 0
+        else:
+            assert(False)
+        return mask
+
+    def load_images(self, files, cache=None):
+        """Returns `files` as a float32 batch.
+
+        Files that `cache` holds are read from it; only the others are
+        decoded.
+        """
+        idxs = cache.lookup(files) if cache is not None else [None]*len(files)
+        batch = np.empty([len(files)] + self.image_shape, dtype=np.float32)
+        hits = [i for i, idx in enumerate(idxs) if idx is not None]
+        if hits:
+            batch[hits] = cache.load([idxs[i] for i in hits])
+        for i, batch_file in enumerate(files):
+            if idxs[i] is None:
+                batch[i] = get_image(batch_file, self.image_size, is_crop=self.is_crop)
+        return batch
+
+    def image_batches(self, files, cache=None):
+        """Yields `(batch_files, batch_images)` in chunks of `batch_size`."""
+        for l in xrange(0, len(files), self.batch_size):
+            batch_files = files[l:l+self.batch_size]
+            yield batch_files, self.load_images(batch_files, cache)
+
+
+class NumpyCompletion(Completion):
+    """Completion with `NumpyDCGAN`, without TensorFlow.
+
+    The weights are those `export-numpy.py` saves. Every slot has its
+    own Adam moments, and z is updated and clipped to [-1, 1] as in
+    `DCGAN.build_latent_optimizer`.
+    """
+    def __init__(self, weights_path, image_size=64, is_crop=False,
+                 batch_size=64, lam=0.1):
+        self.model = NumpyDCGAN(load_weights(weights_path), lam)
+        self.image_size = image_size
+        self.image_shape = [image_size, image_size, 3]
+        self.is_crop = is_crop
+        self.batch_size = batch_size
+        self.z_dim = self.model.z_dim
+        self.use_encoder = False
+        self.checkpoint_id = checkpoint_id(weights_path)
+
+    def prepare_completion(self, config, nSlots, beta1=0.9, beta2=0.999,
+                           epil=1e-8):
+        self.loss = config.loss
+        self.lr = config.lr
+        self.nSteps = config.stepsPerRun
+        self.adam = (beta1, beta2, epil)
+        self.zhat = np.zeros([nSlots, self.z_dim], np.float32)
+        self.zhat_m = np.zeros_like(self.zhat)
+        self.zhat_v = np.zeros_like(self.zhat)
+        return nSlots
+
+    def fill_z(self, slots, zhats):
+        self.zhat[slots] = zhats
+        self.zhat_m[slots] = 0
+        self.zhat_v[slots] = 0
+
+    def run_z_step(self, images, mask, timer, step):
+        beta1, beta2, epil = self.adam
+        for _ in xrange(self.nSteps):
+            z = self.zhat.copy()
+            loss, G, g = self.model.completion_loss(z, images, mask, self.loss,
+                                                    gradient=True)
+            self.zhat_m = beta1*self.zhat_m + (1-beta1)*g
+            self.zhat_v = beta2*self.zhat_v + (1-beta2)*np.square(g)
+            z_t = z - self.lr*self.zhat_m/(np.sqrt(self.zhat_v)+epil)
+            self.zhat = np.clip(z_t, -1, 1).astype(np.float32)
+        # The z that `DCGAN.z_step` fetches shares the buffer of `zhat`,
+        # so it is the updated one as well.
+        return loss, G, self.zhat.copy()
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3.4
+#
+# Writes the completion graph of a trained checkpoint as one frozen
+# GraphDef, with the generator, discriminator and encoder weights as
+# constants. `complete.py --frozen` loads it without building the
+# training graph or restoring the checkpoint.
+
+import argparse
+import os
+import tensorflow as tf
+
+from model import DCGAN
+
+parser = argparse.ArgumentParser()
+parser.add_argument('out', type=str,
+                    help='File to write the graph to; its settings go to OUT.json.')
+parser.add_argument('--checkpointDir', type=str, default='checkpoint')
+parser.add_argument('--encoderDir', type=str, default=None,
+                    help='Encoder checkpoint from train-encoder.py to include.')
+parser.add_argument('--imgSize', type=int, default=64)
+parser.add_argument('--lam', type=float, default=0.1)
+parser.add_argument('--lr', type=float, default=0.01)
+parser.add_argument('--loss', type=int, default=0)
+parser.add_argument('--stepsPerRun', type=int, default=1)
+parser.add_argument('--batchSize', type=int, default=64,
+                    help='Number of images the graph optimizes at once.')
+args = parser.parse_args()
+
+assert(os.path.exists(args.checkpointDir))
+
+with tf.Session() as sess:
+    dcgan = DCGAN(sess, image_size=args.imgSize, batch_size=args.batchSize,
+                  checkpoint_dir=args.checkpointDir, lam=args.lam, mode='complete',
+                  encoder=args.encoderDir is not None)
+    dcgan.export_completion(args.out, args)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3.4
+#
+# Writes the weights of a trained checkpoint for numpy_model.py, which
+# evaluates G, D and the completion gradient without TensorFlow, and
+# for `complete.py --numpyWeights`, which completes images with it. With
+# --check, the NumPy results are compared to the TensorFlow graph on a
+# random batch, and the script fails if any relative error exceeds --tol.
+
+from __future__ import print_function
+import argparse
+import os
+import numpy as np
+import tensorflow as tf
+
+from model import DCGAN
+from numpy_model import NumpyDCGAN, save_weights
+
+parser = argparse.ArgumentParser()
+parser.add_argument('out', type=str, help='.npz file to write the weights to.')
+parser.add_argument('--checkpointDir', type=str, default='checkpoint')
+parser.add_argument('--imgSize', type=int, default=64)
+parser.add_argument('--lam', type=float, default=0.1)
+parser.add_argument('--check', type=int, default=0,
+                    help='Batch size to compare NumPy and TensorFlow on (0 skips the check).')
+parser.add_argument('--tol', type=float, default=1e-4,
+                    help='Largest relative error --check accepts.')
+args = parser.parse_args()
+
+assert(os.path.exists(args.checkpointDir))
+
+with tf.Session() as sess:
+    dcgan = DCGAN(sess, image_size=args.imgSize, checkpoint_dir=args.checkpointDir,
+                  lam=args.lam)
+    losses = [dcgan.completion_loss(dcgan.z, loss) for loss in [0, 1]]
+    grads = [tf.gradients(complete_loss, dcgan.z)[0] for complete_loss, _ in losses]
+    isLoaded = dcgan.load(args.checkpointDir)
+    assert(isLoaded)
+
+    weights = dcgan.numpy_weights()
+    save_weights(args.out, weights)
+    print(" [*] Wrote %d arrays to %s" % (len(weights), args.out))
+
+    if args.check > 0:
+        model = NumpyDCGAN(weights, lam=args.lam)
+        z = np.random.uniform(-1, 1, [args.check, dcgan.z_dim]).astype(np.float32)
+        images = np.random.uniform(-1, 1, [args.check] + dcgan.image_shape).astype(np.float32)
+        mask = np.resize(dcgan.make_mask('center'),
+                         [args.check] + dcgan.image_shape).astype(np.float32)
+
+        def error(a, b):
+            return np.abs(a - b).max() / max(np.abs(b).max(), 1e-12)
+
+        sample = sess.run(dcgan.sampler, feed_dict={dcgan.z: z})
+        errors = [error(model.sample(z), sample)]
+        print("sampler: relative error %.2e" % errors[0])
+        for loss in [0, 1]:
+            tf_loss, tf_G, tf_grad = sess.run(list(losses[loss]) + [grads[loss]], feed_dict={
+                dcgan.z: z, dcgan.images: images, dcgan.mask: mask})
+            np_loss, np_G, np_grad = model.completion_loss(z, images, mask, loss, gradient=True)
+            errs = [error(np_loss, tf_loss), error(np_G, tf_G), error(np_grad, tf_grad)]
+            print("loss %d: relative error of loss %.2e, G %.2e, z-gradient %.2e" % tuple(
+                [loss] + errs))
+            errors += errs
+        if max(errors) > args.tol:
+            raise SystemExit("NumPy and TensorFlow differ by more than %g" % args.tol)
@@ -0,0 +1,22 @@
+#!/usr/bin/env python3.4
+#
+# Decodes a directory of images once into a memory-mapped dataset that
+# train-dcgan.py (--dataset_cache) and complete.py (--cache) read from.
+
+import argparse
+import os
+from glob import glob
+
+from utils import ingest_images
+
+parser = argparse.ArgumentParser()
+parser.add_argument('dataset', type=str, help='Directory of .png images.')
+parser.add_argument('out', type=str, help='Output path, without extension.')
+parser.add_argument('--imgSize', type=int, default=64)
+parser.add_argument('--crop', action='store_true')
+args = parser.parse_args()
+
+files = sorted(glob(os.path.join(args.dataset, "*.png")))
+assert(len(files) > 0)
+ingest_images(files, args.out, image_size=args.imgSize, is_crop=args.crop)
+print("Wrote %d images to %s.npy" % (len(files), args.out))
@@ -8,23 +8,30 @@
 from __future__ import division
 import os
 import time
+import json
+import re
 from glob import glob
+from collections import OrderedDict
 import tensorflow as tf
+from tensorflow.python.framework import graph_util
 from six.moves import xrange
 import numpy as np
 from ops import *
 from utils import *
+from numpy_model import NumpyDCGAN
+from postprocess import estimate_masks, poisson_blend
+from completion import Completion
 from PIL import Image
 from scipy import misc, io
-from scipy.sparse import csr_matrix
 from skimage.morphology import closing, opening, square, disk
 
-class DCGAN(object):
+class DCGAN(Completion):
     def __init__(self, sess, image_size=64, is_crop=False,
                  batch_size=64, sample_size=64,
                  z_dim=100, gf_dim=64, df_dim=64,
                  gfc_dim=1024, dfc_dim=1024, c_dim=3,
-                 checkpoint_dir=None, lam=0.1):
+                 checkpoint_dir=None, lam=0.1, mode='train', encoder=False,
+                 frozen=None, devices=None):
         """
 
         Args:
@@ -36,6 +43,12 @@ class DCGAN(object):
             gfc_dim: (optional) Dimension of gen untis for for fully connected layer. [1024]
             dfc_dim: (optional) Dimension of discrim units for fully connected layer. [1024]
             c_dim: (optional) Dimension of image color. [3]
+            mode: (optional) Graph to build: 'train', 'sample' or 'complete'. [train]
+            encoder: (optional) Build the encoder that estimates z for completion. [False]
+            frozen: (optional) Completion graph from `export_completion` to load
+                instead of building the model. [None]
+            devices: (optional) Devices to split training batches across, one
+                tower each. [None]
         """
         self.sess = sess
         self.is_crop = is_crop
@@ -69,42 +82,105 @@ class DCGAN(object):
         self.g_bn3 = batch_norm(name='g_bn3')
 
         self.checkpoint_dir = checkpoint_dir
-        self.build_model()
+        self.mode = mode
+        self.use_encoder = encoder
+        self.devices = devices
+        if devices:
+            assert(batch_size % len(devices) == 0)
+        self.saver = None
+        self.frozen = None
+        if frozen is not None:
+            self.load_frozen(frozen)
+        else:
+            self.build_model()
 
         self.model_name = "DCGAN.model"
 
     def build_model(self):
+        """Builds the graph of `self.mode`.
+
+        'train' builds G, D, the sampler, the GAN losses and their
+        summaries; 'sample' builds G and the sampler; 'complete' builds
+        only the inputs and the batch norm moving averages, and
+        `build_latent_optimizer` or `train_encoder` add the loss they use. The encoder is built in any mode if it
+        was asked for.
+        """
         self.images = tf.placeholder(
             tf.float32, [None] + self.image_shape, name='real_images')
+        self.z = tf.placeholder(tf.float32, [None, self.z_dim], name='z')
+        self.mask = tf.placeholder(tf.float32, [None] + self.image_shape, name='mask')
+
+        # The encoder's variables have to exist before anything turns on
+        # variable reuse.
+        if self.use_encoder:
+            self.z_encoded = self.encoder(self.images, self.mask)
+            self.e_vars = [var for var in tf.trainable_variables()
+                           if var.name.startswith('e_')]
+            self.encoder_saver = tf.train.Saver(self.e_vars, max_to_keep=1)
+
+        if self.mode == 'train':
+            self.build_training()
+        elif self.mode == 'sample':
+            self.G = self.generator(self.z)
+            self.sampler = self.sampler(self.z)
+        else:
+            assert(self.mode == 'complete')
+            # Completion normalizes with the moving averages of training,
+            # so an image's result does not depend on the rest of its batch.
+            for bn, depth in self.batch_norms():
+                bn.moving_averages(depth)
+
+    def build_training(self):
+        """Builds the GAN losses on one tower per device in `self.devices`.
+
+        Every tower takes an equal share of the batch. The first one is
+        built exactly like a single tower and is the only one that updates
+        the batch norm moving averages; the others share its variables
+        and normalize with the statistics of their own share. The losses
+        are averaged over the towers, and `train` averages the gradients
+        of `tower_d_losses` and `tower_g_losses`.
+        """
         self.sample_images= tf.placeholder(
             tf.float32, [None] + self.image_shape, name='sample_images')
-        self.z = tf.placeholder(tf.float32, [None, self.z_dim], name='z')
         self.z_sum = tf.histogram_summary("z", self.z)
 
-        self.G = self.generator(self.z)
-        self.D, self.D_logits = self.discriminator(self.images)
+        devices = self.devices or [None]
+        if len(devices) > 1:
+            images = tf.split(0, len(devices), self.images)
+            zs = tf.split(0, len(devices), self.z)
+        else:
+            images, zs = [self.images], [self.z]
+
+        with tf.device(devices[0]):
+            self.G = self.generator(zs[0])
+            self.D, self.D_logits = self.discriminator(images[0])
 
-        self.sampler = self.sampler(self.z)
-        self.D_, self.D_logits_ = self.discriminator(self.G, reuse=True)
+            self.sampler = self.sampler(self.z)
+            self.D_, self.D_logits_ = self.discriminator(self.G, reuse=True)
+            towers = [gan_losses(self.D_logits, self.D_logits_)]
+
+        for i in xrange(1, len(devices)):
+            with tf.device(devices[i]), tf.name_scope('tower_%d' % i):
+                G = self.generator(zs[i], reuse=True, update=False)
+                _, D_logits = self.discriminator(images[i], reuse=True, update=False)
+                _, D_logits_ = self.discriminator(G, reuse=True, update=False)
+                towers.append(gan_losses(D_logits, D_logits_))
 
         self.d_sum = tf.histogram_summary("d", self.D)
         self.d__sum = tf.histogram_summary("d_", self.D_)
         self.G_sum = tf.image_summary("G", self.G)
 
-        self.d_loss_real = tf.reduce_mean(
-            tf.nn.sigmoid_cross_entropy_with_logits(self.D_logits,
-                                                    tf.ones_like(self.D)))
-        self.d_loss_fake = tf.reduce_mean(
-            tf.nn.sigmoid_cross_entropy_with_logits(self.D_logits_,
-                                                    tf.zeros_like(self.D_)))
-        self.g_loss = tf.reduce_mean(
-            tf.nn.sigmoid_cross_entropy_with_logits(self.D_logits_,
-                                                    tf.ones_like(self.D_)))
+        d_loss_real, d_loss_fake, g_loss = zip(*towers)
+        self.d_loss_real = mean(d_loss_real)
+        self.d_loss_fake = mean(d_loss_fake)
+        self.g_loss = mean(g_loss)
 
         self.d_loss_real_sum = tf.scalar_summary("d_loss_real", self.d_loss_real)
         self.d_loss_fake_sum = tf.scalar_summary("d_loss_fake", self.d_loss_fake)
 
         self.d_loss = self.d_loss_real + self.d_loss_fake
+        self.tower_d_losses = [real + fake for real, fake in zip(d_loss_real, d_loss_fake)]
+        self.tower_g_losses = list(g_loss)
 
         self.g_loss_sum = tf.scalar_summary("g_loss", self.g_loss)
         self.d_loss_sum = tf.scalar_summary("d_loss", self.d_loss)
@@ -114,40 +190,33 @@ class DCGAN(object):
         self.d_vars = [var for var in t_vars if 'd_' in var.name]
         self.g_vars = [var for var in t_vars if 'g_' in var.name]
 
-        self.saver = tf.train.Saver(max_to_keep=1)
-
-        # Completion.
-        self.mask = tf.placeholder(tf.float32, [None] + self.image_shape, name='mask')
-        self.contextual_loss = tf.reduce_sum(
-            tf.contrib.layers.flatten(
-                tf.abs(tf.mul(self.mask, self.G) - tf.mul(self.mask, self.images))), 1)
-        self.perceptual_loss = self.g_loss
-        self.complete_loss = self.contextual_loss + self.lam*self.perceptual_loss
-        self.grad_complete_loss = tf.gradients(self.complete_loss, self.z)
-
-
-
-        self.X = tf.mul(1-self.mask, self.G) + tf.mul(self.mask, self.images)
-        self.D_2, self.D_logits_2 = self.discriminator(self.X , reuse=True)
-        self.perceptual_loss_2 = tf.reduce_mean(
-            tf.nn.sigmoid_cross_entropy_with_logits(self.D_logits_2,
-                                                    tf.ones_like(self.D_2)))
-
-        self.complete_loss_2 = self.contextual_loss + self.lam*self.perceptual_loss_2
-
-        self.grad_complete_loss_2 = tf.gradients(self.complete_loss_2, self.z)
-
-
-
     def train(self, config):
-        data = glob(os.path.join(config.dataset, "*.png"))
+        # A dataset written by ingest-images.py is sliced instead of decoded.
+        cache = ImageCache(config.dataset_cache) if config.dataset_cache else None
+        if cache is None:
+            data = glob(os.path.join(config.dataset, "*.png"))
+        else:
+            assert(cache.image_size == self.image_size)
+            assert(cache.is_crop == self.is_crop)
+            data = cache.files
         #np.random.shuffle(data)
         assert(len(data) > 0)
-
-        d_optim = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1) \
-                          .minimize(self.d_loss, var_list=self.d_vars)
-        g_optim = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1) \
-                          .minimize(self.g_loss, var_list=self.g_vars)
+        # The losses are logged from the update runs.
+        assert(config.d_steps >= 1 and config.g_steps >= 1)
+
+        # The gradients of every tower are computed on its own device
+        # and averaged.
+        d_opt = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1)
+        d_optim = d_opt.apply_gradients(average_gradients(
+            [d_opt.compute_gradients(loss, var_list=self.d_vars,
+                                     colocate_gradients_with_ops=True)
+             for loss in self.tower_d_losses]))
+        g_opt = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1)
+        g_optim = g_opt.apply_gradients(average_gradients(
+            [g_opt.compute_gradients(loss, var_list=self.g_vars,
+                                     colocate_gradients_with_ops=True)
+             for loss in self.tower_g_losses]))
+        self.build_snapshot()
         tf.initialize_all_variables().run()
 
         self.g_sum = tf.merge_summary(
@@ -158,11 +227,15 @@ class DCGAN(object):
 
         sample_z = np.random.uniform(-1, 1, size=(self.sample_size , self.z_dim))
         sample_files = data[0:self.sample_size]
-        sample = [get_image(sample_file, self.image_size, is_crop=self.is_crop) for sample_file in sample_files]
-        sample_images = np.array(sample).astype(np.float32)
+        sample_images = self.load_images(sample_files, cache)
 
         counter = 1
         start_time = time.time()
+        timer = PhaseTimer(config.timings, parse_steps(config.trace_steps), config.trace_dir)
+        # Checkpoints and sample sheets are written from a snapshot of
+        # the variables while training goes on.
+        worker = BackgroundWorker()
+        checkpoints = []
 
         if self.load(self.checkpoint_dir):
             print("""
@@ -188,435 +261,579 @@ Initializing a new one.
 """)
 
         for epoch in xrange(config.epoch):
-            data = glob(os.path.join(config.dataset, "*.png"))
+            if cache is None:
+                data = glob(os.path.join(config.dataset, "*.png"))
             batch_idxs = min(len(data), config.train_size) // self.batch_size
 
-            for idx in xrange(0, batch_idxs):
-                batch_files = data[idx*config.batch_size:(idx+1)*config.batch_size]
-                batch = [get_image(batch_file, self.image_size, is_crop=self.is_crop)
-                         for batch_file in batch_files]
-                batch_images = np.array(batch).astype(np.float32)
-
+            # Batches are decoded by config.loaders threads, up to
+            # config.prefetch batches ahead of the training step.
+            if cache is None:
+                load = self.load_images
+                batches = [data[idx*config.batch_size:(idx+1)*config.batch_size]
+                           for idx in xrange(0, batch_idxs)]
+            else:
+                load = cache.load
+                batches = [slice(idx*config.batch_size, (idx+1)*config.batch_size)
+                           for idx in xrange(0, batch_idxs)]
+            loader = Prefetcher(load, batches,
+                                size=config.prefetch, nThreads=config.loaders)
+            for idx, batch_images in enumerate(timer.iterate(loader, 'load')):
                 batch_z = np.random.uniform(-1, 1, [config.batch_size, self.z_dim]) \
                             .astype(np.float32)
 
-                # Update D network
-                _, summary_str = self.sess.run([d_optim, self.d_sum],
-                    feed_dict={ self.images: batch_images, self.z: batch_z })
-                self.writer.add_summary(summary_str, counter)
-
-                # Update G network
-                _, summary_str = self.sess.run([g_optim, self.g_sum],
-                    feed_dict={ self.z: batch_z })
-                self.writer.add_summary(summary_str, counter)
-
-                # Run g_optim twice to make sure that d_loss does not go to zero (different from paper)
-                _, summary_str = self.sess.run([g_optim, self.g_sum],
-                    feed_dict={ self.z: batch_z })
-                self.writer.add_summary(summary_str, counter)
+                # The losses come from the same runs that apply the
+                # updates, measured just before each update.
+                log = np.mod(counter, config.log_interval) == 0
 
-                errD_fake = self.d_loss_fake.eval({self.z: batch_z})
-                errD_real = self.d_loss_real.eval({self.images: batch_images})
-                errG = self.g_loss.eval({self.z: batch_z})
+                # Update D network
+                with timer.phase('d_step', step=counter):
+                    for i in xrange(config.d_steps):
+                        fetches = [d_optim, self.d_loss_fake, self.d_loss_real]
+                        if log:
+                            fetches.append(self.d_sum)
+                        results = timer.run(self.sess, fetches,
+                            { self.images: batch_images, self.z: batch_z }, 'd_step', counter, i)
+                        errD_fake, errD_real = results[1:3]
+                if log:
+                    with timer.phase('summary', step=counter):
+                        self.writer.add_summary(results[3], counter)
+
+                # Update G network; running g_optim more than once (2 by
+                # default) makes sure that d_loss does not go to zero
+                # (different from paper)
+                with timer.phase('g_step', step=counter):
+                    for i in xrange(config.g_steps):
+                        fetches = [g_optim, self.g_loss]
+                        if log:
+                            fetches.append(self.g_sum)
+                        results = timer.run(self.sess, fetches,
+                            { self.z: batch_z }, 'g_step', counter, i)
+                        errG = results[1]
+                if log:
+                    with timer.phase('summary', step=counter):
+                        self.writer.add_summary(results[2], counter)
 
                 counter += 1
-                print("Epoch: [%2d] [%4d/%4d] time: %4.4f, d_loss: %.8f, g_loss: %.8f" \
-                    % (epoch, idx, batch_idxs,
-                        time.time() - start_time, errD_fake+errD_real, errG))
-
-                if np.mod(counter, 100) == 1:
-                    samples, d_loss, g_loss = self.sess.run(
-                        [self.sampler, self.d_loss, self.g_loss],
-                        feed_dict={self.z: sample_z, self.images: sample_images}
-                    )
-                    save_images(samples, [8, 8],
-                                './samples/train_{:02d}_{:04d}.png'.format(epoch, idx))
-                    print("[Sample] d_loss: %.8f, g_loss: %.8f" % (d_loss, g_loss))
-
-                if np.mod(counter, 500) == 2:
-                    self.save(config.checkpoint_dir, counter)
-
-
-
-    def complete(self, config):
-        #####################################################
-        # This function was modified by Yu-An Chen and Wei-Che Chen
-        #####################################################
-        os.makedirs(os.path.join(config.outDir, 'hats_imgs'))
-        os.makedirs(os.path.join(config.outDir, 'completed'))
-        os.makedirs(os.path.join(config.outDir, 'mask'))
+                if log:
+                    print("Epoch: [%2d] [%4d/%4d] time: %4.4f, d_loss: %.8f, g_loss: %.8f, queue: %d/%d" \
+                        % (epoch, idx, batch_idxs,
+                            time.time() - start_time, errD_fake+errD_real, errG,
+                            loader.occupancy(), config.prefetch))
+
+                sample = config.sample_interval > 0 and \
+                    np.mod(counter, config.sample_interval) == 1
+                checkpoint = config.checkpoint_interval > 0 and \
+                    np.mod(counter, config.checkpoint_interval) == 2
+                if sample or checkpoint:
+                    # A new snapshot waits for the last one to be written.
+                    with timer.phase('snapshot', step=counter):
+                        records = worker.wait()
+                        self.sess.run(self.snapshot)
+                    # The writes are timed on the worker.
+                    for fields in sum(records, []):
+                        timer.record(**fields)
+                if sample:
+                    worker.run(self.save_samples, sample_z, sample_images,
+                               './samples/train_{:02d}_{:04d}.png'.format(epoch, idx),
+                               counter)
+                if checkpoint:
+                    worker.run(self.save_snapshot, config, counter, checkpoints)
+
+        with timer.phase('flush'):
+            records = worker.wait()
+        for fields in sum(records, []):
+            timer.record(**fields)
+        timer.close()
+
+
+    def train_encoder(self, config):
+        """Trains the encoder against the frozen generator of the checkpoint.
+
+        Every step generates images from random z and masks each of them
+        with one of `config.mask_types`. The encoder learns to recover z
+        from the masked images; the contextual loss of the generator at
+        its estimate is added with weight `config.context_weight`.
+        """
+        target = tf.stop_gradient(
+            self.generator(self.z, reuse=self.mode != 'complete', train=False))
+        z_est = self.encoder(target, self.mask, reuse=True)
+        G_est = self.generator(z_est, reuse=True, train=False)
+        z_loss = tf.reduce_mean(tf.reduce_sum(tf.square(z_est - self.z), 1))
+        contextual_loss = tf.reduce_mean(tf.reduce_sum(
+            tf.contrib.layers.flatten(
+                tf.abs(tf.mul(self.mask, G_est) - tf.mul(self.mask, target))), 1))
+        e_loss = z_loss + config.context_weight*contextual_loss
+        e_optim = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1) \
+                          .minimize(e_loss, var_list=self.e_vars)
         tf.initialize_all_variables().run()
 
         isLoaded = self.load(self.checkpoint_dir)
         assert(isLoaded)
+        if self.load_encoder(config.encoder_dir):
+            print(" [*] Continuing from the encoder in " + config.encoder_dir)
 
-        #data = glob(os.path.join(config.dataset, "*.png"))
-        nImgs = len(config.imgs)
-
-        #batch_idxs = int(np.ceil(nImgs/self.batch_size))
-        if config.maskType == 'random':
-            fraction_masked = 0.2
-            mask = np.ones(self.image_shape)
-            mask[np.random.random(self.image_shape[:2]) < fraction_masked] = 0.0
-        elif config.maskType == 'center':
-            scale = 0.25
-            assert(scale <= 0.5)
-            mask = np.ones(self.image_shape)
-            sz = self.image_size
-            l = int(self.image_size*scale)
-            u = int(self.image_size*(1.0-scale))
-            mask[l:u, l:u, :] = 0.0
-        elif config.maskType == 'left':
-            mask = np.ones(self.image_shape)
-            c = self.image_size // 2
-            mask[:,:c,:] = 0.0
-        elif config.maskType == 'full':
-            mask = np.ones(self.image_shape)
-        elif config.maskType == 'Eye':
-            mask = np.ones(self.image_shape)
-            mask[:26,:,:] = 0
-        elif config.maskType == 'Scarf':
-            mask = np.ones(self.image_shape)
-            mask[25:,:,:] = 0
+        mask_types = config.mask_types.split(',')
+        start_time = time.time()
+        for step in xrange(1, config.steps+1):
+            batch_z = np.random.uniform(-1, 1, [self.batch_size, self.z_dim]) \
+                        .astype(np.float32)
+            batch_mask = np.array([self.make_mask(t) for t in
+                                   np.random.choice(mask_types, self.batch_size)])
+            _, errZ, errC = self.sess.run([e_optim, z_loss, contextual_loss],
+                feed_dict={self.z: batch_z, self.mask: batch_mask})
+
+            if np.mod(step, config.log_interval) == 0:
+                print("Step: [%5d/%5d] time: %4.4f, z_loss: %.8f, contextual_loss: %.8f" \
+                    % (step, config.steps, time.time() - start_time, errZ, errC))
+            if np.mod(step, config.save_interval) == 0 or step == config.steps:
+                self.save_encoder(config.encoder_dir, step)
+
+    def prepare_completion(self, config, nSlots):
+        """Builds the z optimizer and restores the weights it needs.
+
+        Returns the number of slots, which a frozen graph fixes
+        regardless of `nSlots`.
+        """
+        if self.frozen is None:
+            ## 0 for original loss, 1 for our revised loss
+            self.build_latent_optimizer(config.loss, config.lr, config.stepsPerRun, nSlots)
+            tf.initialize_all_variables().run()
+
+            isLoaded = self.load(self.checkpoint_dir)
+            assert(isLoaded)
+            if self.use_encoder:
+                isLoaded = self.load_encoder(config.encoderDir)
+                assert(isLoaded)
+        else:
+            # The exported graph fixes the slots and optimizer settings.
+            nSlots = self.frozen['nSlots']
+            for name in ['loss', 'lr', 'stepsPerRun']:
+                if getattr(config, name) != self.frozen[name]:
+                    print(" [*] Using %s=%s of the frozen graph" % (name, self.frozen[name]))
+                    setattr(config, name, self.frozen[name])
+        return nSlots
+
+    def fill_z(self, slots, zhats):
+        self.sess.run(self.z_fill, feed_dict={self.z_slots: slots, self.zhat_in: zhats})
+
+    def run_z_step(self, images, mask, timer, step):
+        loss, G_imgs, zhats, _ = timer.run(self.sess, self.z_step, {
+            self.mask: mask,
+            self.images: images}, 'z_step', step)
+        return loss, G_imgs, zhats
+
+    def encode_z(self, images, masks):
+        return self.sess.run(self.z_encoded, feed_dict={self.images: images,
+                                                        self.mask: masks})
+
+    def completion_loss(self, z, loss, reuse=True):
+        """Builds the per-image completion loss for the latent `z`.
+
+        `loss` selects the variant: 0 feeds G(z) to the discriminator,
+        1 feeds the masked blend of G(z) and the input images.
+        Returns the loss vector and the generated images. Batch norm
+        uses the moving averages of training, so every image's loss and
+        gradient only depend on its own z.
+        """
+        G = self.generator(z, reuse=reuse, train=False)
+        contextual_loss = tf.reduce_sum(
+            tf.contrib.layers.flatten(
+                tf.abs(tf.mul(self.mask, G) - tf.mul(self.mask, self.images))), 1)
+        if loss == 0:
+            D, D_logits = self.discriminator(G, reuse=reuse, train=False)
         else:
-            assert(False)
-
-        for idx in xrange(0, config.maskIter):
-            l = 0
-            u = nImgs
-            batchSz = u-l
-            batch_files = config.imgs[l:u]
-            batch = [get_image(batch_file, self.image_size, is_crop=self.is_crop)
-                     for batch_file in batch_files]
-            batch_images = np.array(batch).astype(np.float32)
-            if batchSz < self.batch_size:
-                padSz = ((0, int(self.batch_size-batchSz)), (0,0), (0,0), (0,0))
-                batch_images = np.pad(batch_images, padSz, 'constant')
-                batch_images = batch_images.astype(np.float32)
-
-            batch_mask = np.resize(mask, [self.batch_size] + self.image_shape)
-            zhats = np.random.uniform(-1, 1, size=(self.batch_size, self.z_dim))
-            v = 0
-
-            nRows = np.ceil(batchSz/8)
-            nCols = 8
-            save_images(batch_images[:batchSz,:,:,:], [nRows,nCols],
-                        os.path.join(config.outDir, 'before.png'))
-            masked_images = np.multiply(batch_images, batch_mask)
-
-            m = np.zeros((1,self.z_dim)).astype('float32')
-            v = np.zeros((1,self.z_dim)).astype('float32')
-            beta1 = float(0.9)
-            beta2 = float(0.999)
-            epil = 1e-8
-            t = 0
-
-            for i in xrange(config.nIter):
-                fd = {
-                    self.z: zhats,
-                    self.mask: batch_mask,
-                    self.images: batch_images,
-                }
-                ## 0 for original loss, 1 for our revised loss
-                complete_loss = self.complete_loss_2
-                grad_complete_loss = self.grad_complete_loss_2
-                if config.loss == 0:
-                    complete_loss = self.complete_loss
-                    grad_complete_loss = self.grad_complete_loss
-                run = [complete_loss, grad_complete_loss, self.G]
-                loss, g, G_imgs = self.sess.run(run, feed_dict=fd)
-
-                ### Adam optimizer
-                g = np.asarray(g[0])
-                t += 1
-                lr_t = config.lr *np.sqrt(1-beta2**t)/(1-beta1**t)
-                m = beta1*m + (1-beta1)*g
-                v = beta2*v + (1-beta2)*g**2
-                zhats =  zhats -  config.lr*m/(np.sqrt(v)+epil)
-                zhats = zhats.astype('float64')
-                zhats = self.renorm(zhats, 1, 1)
-                zhats = zhats.eval()
-
-                if i % 50 == 0 :
-                    print("Val_loss=",i, np.mean(loss[0:batchSz]))
-                    imgName = os.path.join(config.outDir,
-                                           'hats_imgs/{:04d}.png'.format(i))
-
-                    ### if the masks are updated iteratively, 
-                    ### we save the imgs with the file name of the number of iterations
-
-                    if config.maskIter is not 0:
-                        imgName = os.path.join(config.outDir,
-                                           'hats_imgs/{:02d}.png'.format(idx))
-
-                    nRows = np.ceil(batchSz/8)
-                    nCols = 8
-
-                    save_images(G_imgs[:batchSz,:,:,:], [nRows,nCols], imgName)
-
-                    inv_masked_hat_images = np.multiply(G_imgs, 1.0-batch_mask)
-                    completeed = masked_images + inv_masked_hat_images
-                    imgName = os.path.join(config.outDir,
-                                           'completed/{:04d}.png'.format(i))
-                    if config.maskIter is not 0:
-                        imgName = os.path.join(config.outDir,
-                                           'completed/{:02d}.png'.format(idx))
-
-                    save_images(completeed[:batchSz,:,:,:], [nRows,nCols], imgName)
-
-            if config.maskIter is not 0:
-                print("================== update mask ==============================")
-                mask = np.zeros(batch_mask.shape[:3])
-                for ii in range(self.batch_size):
-                    print ("calculating mask %d......"%(ii))
-                    mask[ii] = self.calc_mask(255*inverse_transform(batch_images[ii]),
-                                                255*inverse_transform(G_imgs[ii]),config)
-
-                maskMat = os.path.join(config.outDir,'mask/{:02d}.mat'.format(idx))
-                io.savemat(maskMat,mdict = {'mask' : mask[4]})
-                mask = np.reshape(mask, (batchSz, mask.shape[1], mask.shape[2],1))
-                mask = np.repeat(mask, 3, axis=3)
-                maskName = os.path.join(config.outDir,'mask/{:02d}.png'.format(idx))
-                nRows = np.ceil(batchSz/8)
-                nCols = 8
-                save_images(mask[:batchSz,:,:,:], [nRows,nCols], maskName)
-
-
-    def discriminator(self, image, reuse=False):
+            X = tf.mul(1-self.mask, G) + tf.mul(self.mask, self.images)
+            D, D_logits = self.discriminator(X, reuse=reuse, train=False)
+        perceptual_loss = tf.nn.sigmoid_cross_entropy_with_logits(
+            tf.reshape(D_logits, [-1]), tf.ones_like(tf.reshape(D, [-1])))
+        return contextual_loss + self.lam*perceptual_loss, G
+
+    def build_latent_optimizer(self, loss, lr, nSteps=1, nSlots=None,
+                               beta1=0.9, beta2=0.999, epil=1e-8):
+        """Builds the Adam update and projection of z into the graph.
+
+        The latent codes live in the `zhat` variable, one row for each of
+        the `nSlots` (default `batch_size`) slots, each with its own Adam
+        moments. `z_fill` loads new codes
+        into the slots listed in `z_slots` and clears their moments. One
+        run of `z_step` applies `nSteps` updates and returns the loss,
+        images and z of the last one, so the optimizer state never leaves
+        the session.
+        """
+        shape = [nSlots or self.batch_size, self.z_dim]
+        self.zhat = tf.Variable(tf.zeros(shape), name='zhat')
+        self.zhat_m = tf.Variable(tf.zeros(shape), name='zhat_m')
+        self.zhat_v = tf.Variable(tf.zeros(shape), name='zhat_v')
+        self.z_slots = tf.placeholder(tf.int32, [None], name='z_slots')
+        self.zhat_in = tf.placeholder(tf.float32, [None, self.z_dim], name='zhat_in')
+        zeros = tf.zeros_like(self.zhat_in)
+        self.z_fill = tf.group(tf.scatter_update(self.zhat, self.z_slots, self.zhat_in),
+                               tf.scatter_update(self.zhat_m, self.z_slots, zeros),
+                               tf.scatter_update(self.zhat_v, self.z_slots, zeros))
+
+        # Each step reads z only after the previous one has written it.
+        deps = []
+        for step in xrange(nSteps):
+            with tf.control_dependencies(deps):
+                z = tf.identity(self.zhat)
+                # In 'complete' mode the first step creates G and D.
+                reuse = step > 0 or self.mode != 'complete'
+                complete_loss, G = self.completion_loss(z, loss, reuse)
+                g = tf.gradients(complete_loss, z)[0]
+                m = tf.assign(self.zhat_m, beta1*self.zhat_m + (1-beta1)*g)
+                v = tf.assign(self.zhat_v, beta2*self.zhat_v + (1-beta2)*tf.square(g))
+                z_t = z - lr*m/(tf.sqrt(v)+epil)
+                # Every row is clipped to the support of the prior on its
+                # own, so no slot's z depends on the others.
+                deps = [tf.assign(self.zhat, tf.clip_by_value(z_t, -1, 1))]
+        self.z_step = [complete_loss, G, z, deps[0]]
+
+    def encoder(self, image, mask, reuse=False):
+        """Estimates z from the known pixels of `image` and its `mask`.
+
+        Follows the discriminator but without batch normalization, so
+        the estimate for an image does not depend on the rest of its
+        batch.
+        """
+        if reuse:
+            tf.get_variable_scope().reuse_variables()
+
+        x = tf.concat(3, [tf.mul(mask, image), tf.slice(mask, [0, 0, 0, 0], [-1, -1, -1, 1])])
+        h0 = lrelu(conv2d(x, self.df_dim, name='e_h0_conv'))
+        h1 = lrelu(conv2d(h0, self.df_dim*2, name='e_h1_conv'))
+        h2 = lrelu(conv2d(h1, self.df_dim*4, name='e_h2_conv'))
+        h3 = lrelu(conv2d(h2, self.df_dim*8, name='e_h3_conv'))
+        h4 = linear(tf.reshape(h3, [-1, 8192]), self.z_dim, 'e_h4_lin')
+
+        return tf.nn.tanh(h4)
+
+    def discriminator(self, image, reuse=False, train=True, update=True):
         if reuse:
             tf.get_variable_scope().reuse_variables()
 
         h0 = lrelu(conv2d(image, self.df_dim, name='d_h0_conv'))
-        h1 = lrelu(self.d_bn1(conv2d(h0, self.df_dim*2, name='d_h1_conv')))
-        h2 = lrelu(self.d_bn2(conv2d(h1, self.df_dim*4, name='d_h2_conv')))
-        h3 = lrelu(self.d_bn3(conv2d(h2, self.df_dim*8, name='d_h3_conv')))
+        h1 = lrelu(self.d_bn1(conv2d(h0, self.df_dim*2, name='d_h1_conv'), train, update))
+        h2 = lrelu(self.d_bn2(conv2d(h1, self.df_dim*4, name='d_h2_conv'), train, update))
+        h3 = lrelu(self.d_bn3(conv2d(h2, self.df_dim*8, name='d_h3_conv'), train, update))
         h4 = linear(tf.reshape(h3, [-1, 8192]), 1, 'd_h3_lin')
 
         return tf.nn.sigmoid(h4), h4
 
-    def generator(self, z):
+    def generator(self, z, reuse=False, train=True, update=True):
+        if reuse:
+            tf.get_variable_scope().reuse_variables()
+
+        # The batch size is read from z, so any number of samples works.
+        batch_size = tf.shape(z)[0]
         self.z_, self.h0_w, self.h0_b = linear(z, self.gf_dim*8*4*4, 'g_h0_lin', with_w=True)
 
         self.h0 = tf.reshape(self.z_, [-1, 4, 4, self.gf_dim * 8])
-        h0 = tf.nn.relu(self.g_bn0(self.h0))
+        h0 = tf.nn.relu(self.g_bn0(self.h0, train, update))
 
         self.h1, self.h1_w, self.h1_b = conv2d_transpose(h0,
-            [self.batch_size, 8, 8, self.gf_dim*4], name='g_h1', with_w=True)
-        h1 = tf.nn.relu(self.g_bn1(self.h1))
+            [batch_size, 8, 8, self.gf_dim*4], name='g_h1', with_w=True)
+        h1 = tf.nn.relu(self.g_bn1(self.h1, train, update))
 
         h2, self.h2_w, self.h2_b = conv2d_transpose(h1,
-            [self.batch_size, 16, 16, self.gf_dim*2], name='g_h2', with_w=True)
-        h2 = tf.nn.relu(self.g_bn2(h2))
+            [batch_size, 16, 16, self.gf_dim*2], name='g_h2', with_w=True)
+        h2 = tf.nn.relu(self.g_bn2(h2, train, update))
 
         h3, self.h3_w, self.h3_b = conv2d_transpose(h2,
-            [self.batch_size, 32, 32, self.gf_dim*1], name='g_h3', with_w=True)
-        h3 = tf.nn.relu(self.g_bn3(h3))
+            [batch_size, 32, 32, self.gf_dim*1], name='g_h3', with_w=True)
+        h3 = tf.nn.relu(self.g_bn3(h3, train, update))
 
         h4, self.h4_w, self.h4_b = conv2d_transpose(h3,
-            [self.batch_size, 64, 64, 3], name='g_h4', with_w=True)
+            [batch_size, 64, 64, 3], name='g_h4', with_w=True)
 
         return tf.nn.tanh(h4)
 
     def sampler(self, z, y=None):
         tf.get_variable_scope().reuse_variables()
 
+        batch_size = tf.shape(z)[0]
         h0 = tf.reshape(linear(z, self.gf_dim*8*4*4, 'g_h0_lin'),
                         [-1, 4, 4, self.gf_dim * 8])
         h0 = tf.nn.relu(self.g_bn0(h0, train=False))
 
-        h1 = conv2d_transpose(h0, [self.batch_size, 8, 8, self.gf_dim*4], name='g_h1')
+        h1 = conv2d_transpose(h0, [batch_size, 8, 8, self.gf_dim*4], name='g_h1')
         h1 = tf.nn.relu(self.g_bn1(h1, train=False))
 
-        h2 = conv2d_transpose(h1, [self.batch_size, 16, 16, self.gf_dim*2], name='g_h2')
+        h2 = conv2d_transpose(h1, [batch_size, 16, 16, self.gf_dim*2], name='g_h2')
         h2 = tf.nn.relu(self.g_bn2(h2, train=False))
 
-        h3 = conv2d_transpose(h2, [self.batch_size, 32, 32, self.gf_dim*1], name='g_h3')
+        h3 = conv2d_transpose(h2, [batch_size, 32, 32, self.gf_dim*1], name='g_h3')
         h3 = tf.nn.relu(self.g_bn3(h3, train=False))
 
-        h4 = conv2d_transpose(h3, [self.batch_size, 64, 64, 3], name='g_h4')
+        h4 = conv2d_transpose(h3, [batch_size, 64, 64, 3], name='g_h4')
 
         return tf.nn.tanh(h4)
 
+    def checkpoint_variables(self):
+        """Returns the variables that checkpoints hold.
+
+        In 'train' mode these are the G and D variables and the optimizer
+        variables, so that training resumes where it stopped. The other
+        modes only restore the G and D variables. The encoder and snapshot
+        variables are never included.
+        """
+        if self.mode == 'train':
+            return [var for var in tf.all_variables()
+                    if not var.name.startswith(('e_', 'snapshot/'))]
+        return [var for var in tf.all_variables()
+                if var.name[:2] in ['g_', 'd_'] and '/Adam' not in var.name]
+
+    def model_saver(self, checkpoint=None):
+        """Returns the Saver for `checkpoint_variables`.
+
+        It is made on first use, once the mode's graph is built. In
+        'complete' mode the moving average variables of batch norm are
+        restored from the averages that training kept in `checkpoint`.
+        """
+        if self.saver is None:
+            variables = self.checkpoint_variables()
+            if self.mode == 'complete':
+                variables = OrderedDict((var.op.name, var) for var in variables)
+                for name, var in self.moving_average_names(checkpoint).items():
+                    del variables[var.op.name]
+                    variables[name] = var
+            self.saver = tf.train.Saver(variables, max_to_keep=1)
+        return self.saver
+
+    def batch_norms(self):
+        """Returns the batch norms of G and D with their depths."""
+        return [(self.g_bn0, self.gf_dim*8), (self.g_bn1, self.gf_dim*4),
+                (self.g_bn2, self.gf_dim*2), (self.g_bn3, self.gf_dim),
+                (self.d_bn1, self.df_dim*2), (self.d_bn2, self.df_dim*4),
+                (self.d_bn3, self.df_dim*8)]
+
+    def moving_average_names(self, checkpoint):
+        """Maps the names of the moving averages in `checkpoint` to the
+        variables of `batch_norm.moving_averages`.
+
+        Training keeps a mean and a variance, named
+        `<bn>.../ExponentialMovingAverage`, for every application of a
+        batch norm that updates them; D has one pair for the real and
+        one for the generated images. Sorted by name, the mean comes
+        before its variance and the pairs come in the order they were
+        applied. The last pair is used, as in `numpy_weights`.
+        """
+        shapes = tf.train.NewCheckpointReader(checkpoint).get_variable_to_shape_map()
+        averages = OrderedDict()
+        for bn, depth in self.batch_norms():
+            pattern = re.compile(r'^%s(_\d+)?/.*ExponentialMovingAverage$' % bn.name)
+            names = sorted(name for name, shape in shapes.items()
+                           if pattern.match(name) and shape == [depth])
+            assert len(names) >= 2 and len(names) % 2 == 0, \
+                "no moving averages of %s in %s" % (bn.name, checkpoint)
+            averages[names[-2]] = bn.ema_mean
+            averages[names[-1]] = bn.ema_var
+        return averages
+
+    def build_snapshot(self):
+        """Adds copies of `checkpoint_variables` and the op that fills them.
+
+        Running `snapshot` copies the variables inside the session;
+        `snapshot_saver` writes the copies under the original names, so
+        its checkpoints load like those of `save`.
+        """
+        self.snapshot_vars = OrderedDict()
+        for var in self.checkpoint_variables():
+            self.snapshot_vars[var.op.name] = tf.Variable(
+                tf.zeros(var.get_shape()), trainable=False, name='snapshot/' + var.op.name)
+        self.snapshot = tf.group(*[tf.assign(self.snapshot_vars[var.op.name], var)
+                                   for var in self.checkpoint_variables()])
+        # Old checkpoints are removed by `save_snapshot`.
+        self.snapshot_saver = tf.train.Saver(self.snapshot_vars, max_to_keep=0)
+
+    def save_snapshot(self, config, step, checkpoints):
+        """Writes the snapshot as the checkpoint of `step` and removes old ones.
+
+        `checkpoints` lists the steps of the checkpoints written so far.
+        The last `config.keep_checkpoints` are kept, and with
+        `config.milestone_interval > 0`, so is the first one of every
+        `config.milestone_interval` steps. Returns the timing records of
+        the write, for the caller's `PhaseTimer`.
+        """
+        timer = PhaseTimer(keep=True)
+        with timer.phase('checkpoint', step=step):
+            if not os.path.exists(config.checkpoint_dir):
+                os.makedirs(config.checkpoint_dir)
+            path = os.path.join(config.checkpoint_dir, self.model_name)
+            self.snapshot_saver.save(self.sess, path, global_step=step)
+            checkpoints.append(step)
+
+            keep = set(checkpoints[-max(config.keep_checkpoints, 1):])
+            if config.milestone_interval > 0:
+                periods = set()
+                for s in checkpoints:
+                    if s // config.milestone_interval not in periods:
+                        periods.add(s // config.milestone_interval)
+                        keep.add(s)
+            for s in [s for s in checkpoints if s not in keep]:
+                prefix = '%s-%d' % (path, s)
+                for filename in glob(prefix) + glob(prefix + '.*'):
+                    os.remove(filename)
+                checkpoints.remove(s)
+            paths = ['%s-%d' % (path, s) for s in checkpoints]
+            self.snapshot_saver.set_last_checkpoints(paths)
+            tf.train.update_checkpoint_state(config.checkpoint_dir, paths[-1], paths)
+        return timer.records
+
+    def save_samples(self, sample_z, sample_images, image_path, step):
+        """Writes the sample sheet of the snapshot and prints its losses.
+
+        G and D are evaluated with `NumpyDCGAN`, so the session stays
+        free for training. Returns the timing records, like
+        `save_snapshot`.
+        """
+        timer = PhaseTimer(keep=True)
+        with timer.phase('samples', step=step):
+            model = NumpyDCGAN(self.numpy_weights(snapshot=True))
+            sample_z = sample_z.astype(np.float32)
+            samples = model.sample(sample_z)
+            save_images(samples, [8, 8], image_path)
+
+            real, _ = model.discriminator(sample_images)
+            fake, _ = model.discriminator(model.generator(sample_z)[0])
+            d_loss = np.mean(np.logaddexp(0, -real)) + np.mean(np.logaddexp(0, fake))
+            g_loss = np.mean(np.logaddexp(0, -fake))
+        print("[Sample] d_loss: %.8f, g_loss: %.8f" % (d_loss, g_loss))
+        return timer.records
+
     def save(self, checkpoint_dir, step):
         if not os.path.exists(checkpoint_dir):
             os.makedirs(checkpoint_dir)
 
-        self.saver.save(self.sess,
-                        os.path.join(checkpoint_dir, self.model_name),
-                        global_step=step)
+        self.model_saver().save(self.sess,
+                                os.path.join(checkpoint_dir, self.model_name),
+                                global_step=step)
 
     def load(self, checkpoint_dir):
         print(" [*] Reading checkpoints...")
 
         ckpt = tf.train.get_checkpoint_state(checkpoint_dir)
         if ckpt and ckpt.model_checkpoint_path:
-            self.saver.restore(self.sess, ckpt.model_checkpoint_path)
+            self.model_saver(ckpt.model_checkpoint_path).restore(
+                self.sess, ckpt.model_checkpoint_path)
+            self.checkpoint_id = checkpoint_id(ckpt.model_checkpoint_path)
             return True
         else:
             return False
 
-    def renorm(self,x, axis, max_norm):
-        
-        #####################################################
-        # This function was modified by Yu-An Chen and Wei-Che Chen
-        # code reference to http://stackoverflow.com/questions/34934303/renormalize-weight-matrix-using-tensorflow
-        #####################################################
-        '''Renormalizes the sub-tensors along axis such that they do not exceed norm max_norm.'''
-        #This elaborate dance avoids empty slices, which TF dislikes.
-        rank = tf.rank(x)
-        bigrange = tf.range(-1, rank + 1)
-        dims = tf.slice(tf.concat(0, [tf.slice(bigrange,[0], [1 + axis]),
-                        tf.slice(bigrange,[axis+2],[-1])]),[1],rank-[1])
+    def export_completion(self, path, config):
+        """Writes the completion graph, with its weights as constants, to `path`.
 
-        #Determine which columns need to be renormalized.
-        l2norm_inv = tf.rsqrt(tf.reduce_sum(x*x, dims, keep_dims=True))
-        scale = max_norm*tf.minimum(tf.cast(l2norm_inv,tf.float32), tf.constant(1.0/max_norm))
+        The graph holds the z optimizer of `build_latent_optimizer` for
+        `config.loss` with `batch_size` slots, and the encoder if it was
+        built. Its settings and tensor names go to `path + '.json'`.
+        """
+        self.build_latent_optimizer(config.loss, config.lr, config.stepsPerRun)
+        tf.initialize_all_variables().run()
 
-        #Broadcast the scalings
-        return tf.mul(scale,x)
+        isLoaded = self.load(self.checkpoint_dir)
+        assert(isLoaded)
+        if self.use_encoder:
+            isLoaded = self.load_encoder(config.encoderDir)
+            assert(isLoaded)
+
+        # The optimizer state stays variable, the weights become constants.
+        state = [self.zhat, self.zhat_m, self.zhat_v]
+        tensors = {'images': self.images.name, 'mask': self.mask.name,
+                   'z_slots': self.z_slots.name, 'zhat_in': self.zhat_in.name,
+                   'z_step': [t.name for t in self.z_step], 'z_fill': self.z_fill.name,
+                   'init': [var.initializer.name for var in state],
+                   'z_encoded': self.z_encoded.name if self.use_encoder else None}
+        outputs = [t.op.name for t in self.z_step] + [self.z_fill.name] + tensors['init']
+        if self.use_encoder:
+            outputs.append(self.z_encoded.op.name)
+        weights = [var.op.name for var in tf.all_variables()
+                   if var.op.name not in ['zhat', 'zhat_m', 'zhat_v']]
+        graph_def = graph_util.convert_variables_to_constants(
+            self.sess, self.sess.graph.as_graph_def(), outputs,
+            variable_names_whitelist=weights)
+
+        with open(path, 'wb') as f:
+            f.write(graph_def.SerializeToString())
+        with open(path + '.json', 'w') as f:
+            json.dump({'image_size': self.image_size, 'z_dim': self.z_dim,
+                       'nSlots': self.batch_size, 'loss': config.loss, 'lr': config.lr,
+                       'stepsPerRun': config.stepsPerRun, 'lam': self.lam,
+                       'checkpoint': self.checkpoint_id, 'tensors': tensors}, f, indent=2)
+
+    def load_frozen(self, path):
+        """Imports a completion graph written by `export_completion`."""
+        with open(path + '.json') as f:
+            self.frozen = json.load(f)
+        graph_def = tf.GraphDef()
+        with open(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        tf.import_graph_def(graph_def, name='')
+
+        self.image_size = self.frozen['image_size']
+        self.image_shape = [self.image_size, self.image_size, 3]
+        self.z_dim = self.frozen['z_dim']
+        self.lam = self.frozen['lam']
+        self.checkpoint_id = self.frozen['checkpoint']
+
+        graph = self.sess.graph
+        tensors = self.frozen['tensors']
+        self.images = graph.get_tensor_by_name(tensors['images'])
+        self.mask = graph.get_tensor_by_name(tensors['mask'])
+        self.z_slots = graph.get_tensor_by_name(tensors['z_slots'])
+        self.zhat_in = graph.get_tensor_by_name(tensors['zhat_in'])
+        self.z_step = [graph.get_tensor_by_name(name) for name in tensors['z_step']]
+        self.z_fill = graph.get_operation_by_name(tensors['z_fill'])
+        self.use_encoder = tensors['z_encoded'] is not None
+        if self.use_encoder:
+            self.z_encoded = graph.get_tensor_by_name(tensors['z_encoded'])
+        self.sess.run([graph.get_operation_by_name(name) for name in tensors['init']])
+
+    def numpy_weights(self, snapshot=False):
+        """Returns the weights for `numpy_model.NumpyDCGAN` as float32 arrays.
+
+        These are the G and D variables by name, plus the moving averages
+        of the batch norms as `<bn>/moving_mean` and `<bn>/moving_variance`,
+        taken from the last snapshot if `snapshot`. Needs the 'train'
+        mode graph.
+        """
+        variables = OrderedDict((var.op.name, var) for var in self.g_vars + self.d_vars)
+        for bn, _ in self.batch_norms():
+            variables[bn.name + '/moving_mean'] = bn.ema_mean
+            variables[bn.name + '/moving_variance'] = bn.ema_var
+        if snapshot:
+            variables = OrderedDict((name, self.snapshot_vars[var.op.name])
+                                    for name, var in variables.items())
+        values = self.sess.run(list(variables.values()))
+        return OrderedDict((name, np.ascontiguousarray(value, dtype=np.float32))
+                           for name, value in zip(variables, values))
+
+    def save_encoder(self, encoder_dir, step):
+        if not os.path.exists(encoder_dir):
+            os.makedirs(encoder_dir)
+
+        self.encoder_saver.save(self.sess,
+                                os.path.join(encoder_dir, "encoder.model"),
+                                global_step=step)
+
+    def load_encoder(self, encoder_dir):
+        ckpt = tf.train.get_checkpoint_state(encoder_dir)
+        if ckpt and ckpt.model_checkpoint_path:
+            self.encoder_saver.restore(self.sess, ckpt.model_checkpoint_path)
+            return True
+        else:
+            return False
 
     def calc_mask(self,y0, x_recon0,config):
         #####################################################
         # This function was modified by Yu-An Chen and Wei-Che Chen
         #####################################################
-        threshold = config.threshold
-        median_e = 0.6
-        mu_delta = 8
-        w = np.zeros(y0.shape)
-
-        for k in range(3):
-            y = y0[:,:,k].flatten('F')
-            y = np.reshape(y,(-1,1))
-            y = np.array(y, dtype=np.float32)
-
-            x_recon = x_recon0[:,:,k].flatten('F')
-            x_recon = np.reshape(x_recon,(-1,1))
-            x_recon = np.array(x_recon, dtype=np.float32)
-
-            residual = np.square(y-x_recon)
-            residual_sort = np.sort(residual, axis=0)
-            delta = residual_sort[np.ceil(median_e*y.shape[0])]
-            mu = (1.0*mu_delta)/(delta + 1e-10)
-            wt = 1.0/(1+1.0/np.exp(-mu*(residual-delta)))
-            w[:,:,k] = np.reshape(wt.T, (w.shape[1], w.shape[0])).T
-
-        mk0 = (w[:,:,0] + w[:,:,1] + w[:,:,2])/3
-        mk = mk0.flatten('F')
-        mk[ np.argwhere(mk < threshold)] = 0
-        mk[ np.argwhere(mk >= threshold)] = 1
-        mk = np.reshape(mk.T, (y0.shape[1],y0.shape[0]))
-        #for i in range(mk.shape[0]):
-        #    mk[i] = closing(mk[i], disk(4))
-        #    mk[i] = opening(mk[i], disk(2))
-        mk = closing(mk, disk(config.closeDisk))
-        mk = opening(mk, disk(config.openDisk))
-        return mk.T
+        return self.calc_masks(y0[np.newaxis], x_recon0[np.newaxis], config)[0]
+
+    def calc_masks(self, y0, x_recon0, config):
+        return estimate_masks(y0, x_recon0, config)
 
     def blending(self, source, target, mask):
         #####################################################
         # This function was modified by Yu-An Chen and Wei-Che Chen
         #####################################################
-
-        temp1 = np.zeros((source.shape[0]+2,source.shape[1]+2,source.shape[2]))
-
-        temp2 = np.zeros((source.shape[0]+2,source.shape[1]+2,source.shape[2]))
-
-        for i in range(3):
-            temp1[:,:,i] = np.lib.pad(source[:,:,i],(1,1),'symmetric')
-            temp2[:,:,i] = np.lib.pad(target[:,:,i],(1,1),'symmetric')
-        source = temp1
-        target = temp2
-        print("shape t", target.shape)
-        mask = np.lib.pad(mask,(1,1),'constant', constant_values=(0,0))
-
-        t_rows = target.shape[0]
-        t_cols = target.shape[1]
-
-
-        s = np.reshape(source,(t_rows*t_cols,-1),order='F')
-        t = np.reshape(target,(t_rows*t_cols,-1),order='F')
-        print("shape t ", t.shape)
-        b = np.zeros((t_rows*t_cols, 3));
-        print("shape b ",b.shape)
-        print("constructing the matrix A...")
-        print("shape s ", s.shape)
-
-        #row_vec = np.zeros((t_rows*t_cols, 1))
-        #col_vec = np.zeros((t_rows*t_cols,1 ))
-        #value_vec = np.zeros((t_rows*t_cols,1 ))
-        row_vec = []
-        col_vec = []
-        value_vec = []
-
-        equation_num = 0
-
-
-        for i in range(t_rows*t_cols):
-            row = i%t_rows
-            col = i/t_rows
-            if mask[row,col] != 0:
-                b[i,:] = 4*s[i,:] - s[i-1,:] - s[i+1,:] - s[i+t_rows,:] - s[i-t_rows,:]
-                #b[i,:] = temp[ii]
-                row_vec.append(i)
-                col_vec.append(i)
-                value_vec.append(4)
-                equation_num += 1
-                #equation_num = equation_num%(t_rows*t_cols)
-
-                row_vec.append(i)
-                col_vec.append(i+1)
-                value_vec.append(-1)
-                equation_num += 1
-                #equation_num = equation_num%(t_rows*t_cols)
-
-                row_vec.append(i)
-                col_vec.append(i-1)
-                value_vec.append(-1)
-                equation_num += 1
-                #equation_num = equation_num%(t_rows*t_cols)
-
-                row_vec.append(i)
-                col_vec.append(i-t_rows)
-                value_vec.append(-1)
-                equation_num += 1
-                #equation_num = equation_num%(t_rows*t_cols)
-
-                row_vec.append(i)
-                col_vec.append(i+t_rows)
-                value_vec.append(-1)
-                equation_num += 1
-                #equation_num = equation_num%(t_rows*t_cols)
-            else:
-                row_vec.append(i)
-                col_vec.append(i)
-                value_vec.append(1)
-                equation_num += 1
-                #equation_num = equation_num%(t_rows*t_cols)
-
-                b[i,:] = t[i,:]
-        row_vec = np.asarray(row_vec)
-        col_vec = np.asarray(col_vec)
-        value_vec = np.asarray(value_vec)
-        print("row_vec",row_vec.shape)
-        print("col_vec",col_vec.shape)
-        #print(value)
-        #A = (row_vec, col_vec, value_vec, t_rows*t_cols, t_rows*t_cols)
-        A = csr_matrix((value_vec, (row_vec, col_vec)), shape=(t_rows*t_cols, t_rows*t_cols)).toarray()
-
-        f_red = np.linalg.solve(A,b[:,0])
-        f_green = np.linalg.solve(A,b[:,1])
-        f_blue = np.linalg.solve(A,b[:,2])
-
-        f_red = np.reshape(f_red, (t_rows, t_cols), order = 'F')
-        f_green = np.reshape(f_green, (t_rows, t_cols), order ='F')
-        f_blue = np.reshape(f_blue, (t_rows, t_cols), order ='F')
-
-        result = np.zeros((t_rows, t_cols, 3))
-        result[:,:,0] = f_red
-        result[:,:,1] = f_green
-        result[:,:,2] = f_blue
-
-        result = result[1:t_rows-1, 1:t_cols-1, :]
-        return result
-
-
+        return poisson_blend(source, target, mask)
@@ -0,0 +1,190 @@
+# The generator and discriminator of model.py in NumPy, with the
+# z-gradient of the completion loss, so that completion can run on
+# machines without TensorFlow. The weights come from
+# `DCGAN.numpy_weights`, saved with `save_weights`.
+
+from __future__ import division
+from collections import OrderedDict
+
+import numpy as np
+
+BN_EPSILON = 1e-5
+
+
+def save_weights(path, weights):
+    np.savez(path, **weights)
+
+def load_weights(path):
+    """Returns the weights in `path` as contiguous float32 arrays."""
+    with np.load(path) as f:
+        return OrderedDict((name, np.ascontiguousarray(f[name], dtype=np.float32))
+                           for name in sorted(f.files))
+
+
+def same_padding(size, out, k, stride):
+    """Returns the (before, after) padding of a 'SAME' convolution."""
+    total = max((out-1)*stride + k - size, 0)
+    return total//2, total - total//2
+
+def conv2d(x, w, stride=2):
+    """tf.nn.conv2d with 'SAME' padding; `w` is [k, k, in, out]."""
+    n, h, wd, _ = x.shape
+    k = w.shape[0]
+    oh, ow = -(-h//stride), -(-wd//stride)
+    ph, pw = same_padding(h, oh, k, stride), same_padding(wd, ow, k, stride)
+    xp = np.pad(x, ((0, 0), ph, pw, (0, 0)), 'constant')
+    out = np.zeros((n, oh, ow, w.shape[3]), np.result_type(x, w))
+    for i in range(k):
+        for j in range(k):
+            out += np.dot(xp[:, i:i+stride*oh:stride, j:j+stride*ow:stride, :], w[i, j])
+    return out
+
+def conv2d_backprop_input(dy, w, shape, stride=2):
+    """The gradient of `conv2d` with respect to its input of `shape`.
+
+    This is also tf.nn.conv2d_transpose of `dy`, with `w` as its
+    [k, k, out, in] filter.
+    """
+    n, h, wd, c = shape
+    _, oh, ow, _ = dy.shape
+    k = w.shape[0]
+    ph, pw = same_padding(h, oh, k, stride), same_padding(wd, ow, k, stride)
+    dxp = np.zeros((n, h+sum(ph), wd+sum(pw), c), np.result_type(dy, w))
+    for i in range(k):
+        for j in range(k):
+            dxp[:, i:i+stride*oh:stride, j:j+stride*ow:stride, :] += np.dot(dy, w[i, j].T)
+    return dxp[:, ph[0]:ph[0]+h, pw[0]:pw[0]+wd, :]
+
+def batch_norm(x, beta, gamma, mean=None, var=None):
+    """Batch norm over all axes but the last, with the batch statistics
+    unless `mean` and `var` are given. Returns the output and what
+    `batch_norm_backward` needs."""
+    batch = mean is None
+    if batch:
+        mean, var = x.mean(axis=(0, 1, 2)), x.var(axis=(0, 1, 2))
+    inv = 1.0/np.sqrt(var + BN_EPSILON)
+    xhat = (x - mean)*inv
+    return xhat*gamma + beta, (xhat, inv, batch)
+
+def batch_norm_backward(dy, gamma, cache):
+    """The input gradient of `batch_norm`."""
+    xhat, inv, batch = cache
+    dxhat = dy*gamma
+    if not batch:
+        return inv*dxhat
+    return inv*(dxhat - dxhat.mean(axis=(0, 1, 2))
+                - xhat*(dxhat*xhat).mean(axis=(0, 1, 2)))
+
+def lrelu(x, leak=0.2):
+    return 0.5*(1+leak)*x + 0.5*(1-leak)*np.abs(x)
+
+def lrelu_backward(dy, x, leak=0.2):
+    return dy*(0.5*(1+leak) + 0.5*(1-leak)*np.sign(x))
+
+def softplus(x):
+    return np.logaddexp(0, x)
+
+def sigmoid(x):
+    return 0.5*(1 + np.tanh(0.5*x))
+
+
+class NumpyDCGAN(object):
+    """G and D of `DCGAN` evaluated with NumPy.
+
+    `weights` maps the TensorFlow variable names of G and D to their
+    values, plus `<bn>/moving_mean` and `<bn>/moving_variance` for the
+    batch norms. Batch norm uses the batch statistics with `train`, and
+    the moving averages otherwise, as the sampler and the completion
+    graph do.
+    """
+    def __init__(self, weights, lam=0.1):
+        self.w = weights
+        self.lam = lam
+        self.z_dim, n = weights['g_h0_lin/Matrix'].shape
+        self.gf_dim = n//(4*4*8)
+
+    def generator(self, z, train=True):
+        """Returns G(z) and what `generator_backward` needs."""
+        w = self.w
+        cache = []
+        h = np.dot(z, w['g_h0_lin/Matrix']) + w['g_h0_lin/bias']
+        h = h.reshape([-1, 4, 4, self.gf_dim*8])
+        for l in range(4):
+            bn = 'g_bn%d' % l
+            stats = () if train else (w[bn + '/moving_mean'], w[bn + '/moving_variance'])
+            h, bn_cache = batch_norm(h, w[bn + '/beta'], w[bn + '/gamma'], *stats)
+            cache.append((h, bn_cache))
+            h = np.maximum(h, 0)
+            layer = 'g_h%d' % (l+1)
+            shape = (len(h), 2*h.shape[1], 2*h.shape[2], w[layer + '/w'].shape[2])
+            h = conv2d_backprop_input(h, w[layer + '/w'], shape) + w[layer + '/biases']
+        G = np.tanh(h)
+        return G, (z, cache, G)
+
+    def generator_backward(self, dG, cache):
+        """Returns the gradient with respect to z."""
+        w = self.w
+        z, layers, G = cache
+        d = dG*(1 - G*G)
+        for l in reversed(range(4)):
+            d = conv2d(d, w['g_h%d/w' % (l+1)])
+            h, bn_cache = layers[l]
+            d = d*(h > 0)
+            d = batch_norm_backward(d, w['g_bn%d/gamma' % l], bn_cache)
+        return np.dot(d.reshape([len(z), -1]), w['g_h0_lin/Matrix'].T)
+
+    def sample(self, z):
+        """G(z) with the moving averages of batch norm, like `DCGAN.sampler`."""
+        return self.generator(z, train=False)[0]
+
+    def discriminator(self, image, train=True):
+        """Returns the logits of D and what `discriminator_backward` needs."""
+        w = self.w
+        cache = []
+        h = image
+        for l in range(4):
+            layer = 'd_h%d_conv' % l
+            x = conv2d(h, w[layer + '/w']) + w[layer + '/biases']
+            bn_cache = None
+            if l > 0:
+                bn = 'd_bn%d' % l
+                stats = () if train else (w[bn + '/moving_mean'], w[bn + '/moving_variance'])
+                x, bn_cache = batch_norm(x, w[bn + '/beta'], w[bn + '/gamma'], *stats)
+            cache.append((h.shape, x, bn_cache))
+            h = lrelu(x)
+        flat = h.reshape([len(h), -1])
+        logits = np.dot(flat, w['d_h3_lin/Matrix']) + w['d_h3_lin/bias']
+        return logits[:, 0], cache
+
+    def discriminator_backward(self, dlogits, cache):
+        """Returns the gradient with respect to the input image."""
+        w = self.w
+        d = np.dot(dlogits[:, np.newaxis], w['d_h3_lin/Matrix'].T)
+        d = d.reshape(cache[-1][1].shape)
+        for l in reversed(range(4)):
+            shape, x, bn_cache = cache[l]
+            d = lrelu_backward(d, x)
+            if l > 0:
+                d = batch_norm_backward(d, w['d_bn%d/gamma' % l], bn_cache)
+            d = conv2d_backprop_input(d, w['d_h%d_conv/w' % l], shape)
+        return d
+
+    def completion_loss(self, z, images, mask, loss=0, gradient=False):
+        """The per-image loss of `DCGAN.completion_loss` and G(z).
+
+        With `gradient`, also returns the gradient of the summed loss
+        with respect to z, as tf.gradients computes it.
+        """
+        G, g_cache = self.generator(z, train=False)
+        X = G if loss == 0 else (1-mask)*G + mask*images
+        logits, d_cache = self.discriminator(X, train=False)
+        diff = mask*G - mask*images
+        contextual = np.abs(diff).reshape([len(z), -1]).sum(axis=1)
+        perceptual = softplus(-logits)
+        complete_loss = contextual + self.lam*perceptual
+        if not gradient:
+            return complete_loss, G
+
+        dX = self.discriminator_backward(-self.lam*sigmoid(-logits), d_cache)
+        dG = mask*np.sign(diff) + (dX if loss == 0 else (1-mask)*dX)
+        return complete_loss, G, self.generator_backward(dG, g_cache)
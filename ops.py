@@ -20,30 +20,46 @@ class batch_norm(object):
             self.ema = tf.train.ExponentialMovingAverage(decay=self.momentum)
             self.name = name
 
-    def __call__(self, x, train=True):
+    def __call__(self, x, train=True, update=True):
+        """Normalizes `x` with its batch statistics, or with their moving
+        averages if not `train`. With `update=False` the batch statistics
+        are used without updating the averages."""
         shape = x.get_shape().as_list()
 
-        if train:
-            with tf.variable_scope(self.name) as scope:
-                self.beta = tf.get_variable("beta", [shape[-1]],
-                                    initializer=tf.constant_initializer(0.))
-                self.gamma = tf.get_variable("gamma", [shape[-1]],
-                                    initializer=tf.random_normal_initializer(1., 0.02))
+        with tf.variable_scope(self.name) as scope:
+            self.beta = tf.get_variable("beta", [shape[-1]],
+                                initializer=tf.constant_initializer(0.))
+            self.gamma = tf.get_variable("gamma", [shape[-1]],
+                                initializer=tf.random_normal_initializer(1., 0.02))
 
+            if train:
                 batch_mean, batch_var = tf.nn.moments(x, [0, 1, 2], name='moments')
-                ema_apply_op = self.ema.apply([batch_mean, batch_var])
-                self.ema_mean, self.ema_var = self.ema.average(batch_mean), self.ema.average(batch_var)
+                if update:
+                    ema_apply_op = self.ema.apply([batch_mean, batch_var])
+                    self.ema_mean, self.ema_var = self.ema.average(batch_mean), self.ema.average(batch_var)
 
-                with tf.control_dependencies([ema_apply_op]):
-                    mean, var = tf.identity(batch_mean), tf.identity(batch_var)
-        else:
-            mean, var = self.ema_mean, self.ema_var
+                    with tf.control_dependencies([ema_apply_op]):
+                        mean, var = tf.identity(batch_mean), tf.identity(batch_var)
+                else:
+                    mean, var = batch_mean, batch_var
+            else:
+                mean, var = self.ema_mean, self.ema_var
 
         normed = tf.nn.batch_norm_with_global_normalization(
                 x, mean, var, self.beta, self.gamma, self.epsilon, scale_after_normalization=True)
 
         return normed
 
+    def moving_averages(self, depth):
+        """Creates variables for the moving averages of a graph that
+        never updates them, such as the completion graph. They are
+        restored from the averages kept in training."""
+        with tf.variable_scope(self.name):
+            self.ema_mean = tf.get_variable("moving_mean", [depth],
+                                initializer=tf.constant_initializer(0.), trainable=False)
+            self.ema_var = tf.get_variable("moving_variance", [depth],
+                                initializer=tf.constant_initializer(1.), trainable=False)
+
 def binary_cross_entropy(preds, targets, name=None):
     """Computes binary cross entropy given `preds`.
 
@@ -85,9 +101,13 @@ def conv2d(input_, output_dim,
 def conv2d_transpose(input_, output_shape,
                      k_h=5, k_w=5, d_h=2, d_w=2, stddev=0.02,
                      name="conv2d_transpose", with_w=False):
+    # The batch dimension of output_shape may be a scalar tensor, e.g.
+    # tf.shape(input_)[0], so the graph works for any batch size.
+    static_shape = [d if isinstance(d, int) else None for d in output_shape]
+    output_shape = tf.pack(output_shape)
     with tf.variable_scope(name):
         # filter : [height, width, output_channels, in_channels]
-        w = tf.get_variable('w', [k_h, k_h, output_shape[-1], input_.get_shape()[-1]],
+        w = tf.get_variable('w', [k_h, k_h, static_shape[-1], input_.get_shape()[-1]],
                             initializer=tf.random_normal_initializer(stddev=stddev))
 
         try:
@@ -98,8 +118,9 @@ def conv2d_transpose(input_, output_shape,
         except AttributeError:
             deconv = tf.nn.deconv2d(input_, w, output_shape=output_shape,
                                 strides=[1, d_h, d_w, 1])
+        deconv.set_shape(static_shape)
 
-        biases = tf.get_variable('biases', [output_shape[-1]], initializer=tf.constant_initializer(0.0))
+        biases = tf.get_variable('biases', [static_shape[-1]], initializer=tf.constant_initializer(0.0))
         # deconv = tf.reshape(tf.nn.bias_add(deconv, biases), deconv.get_shape())
         deconv = tf.nn.bias_add(deconv, biases)
 
@@ -126,3 +147,32 @@ def linear(input_, output_size, scope=None, stddev=0.02, bias_start=0.0, with_w=
             return tf.matmul(input_, matrix) + bias, matrix, bias
         else:
             return tf.matmul(input_, matrix) + bias
+
+def mean(tensors):
+    """Averages a list of tensors of the same shape."""
+    if len(tensors) == 1:
+        return tensors[0]
+    return tf.add_n(list(tensors)) / len(tensors)
+
+def average_gradients(tower_grads):
+    """Averages the `(gradient, variable)` lists of several towers.
+
+    The lists must hold the same variables in the same order, as
+    `Optimizer.compute_gradients` returns them for one `var_list`.
+    """
+    return [(mean([g for g, _ in grads_and_vars]), grads_and_vars[0][1])
+            for grads_and_vars in zip(*tower_grads)]
+
+def gan_losses(D_logits, D_logits_):
+    """Returns the real and fake discriminator losses and the generator
+    loss, for the logits of D on real and on generated images."""
+    d_loss_real = tf.reduce_mean(
+        tf.nn.sigmoid_cross_entropy_with_logits(D_logits,
+                                                tf.ones_like(D_logits)))
+    d_loss_fake = tf.reduce_mean(
+        tf.nn.sigmoid_cross_entropy_with_logits(D_logits_,
+                                                tf.zeros_like(D_logits_)))
+    g_loss = tf.reduce_mean(
+        tf.nn.sigmoid_cross_entropy_with_logits(D_logits_,
+                                                tf.ones_like(D_logits_)))
+    return d_loss_real, d_loss_fake, g_loss
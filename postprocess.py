@@ -0,0 +1,196 @@
+# Post-processing of finished completion rounds: occlusion mask
+# estimation, Poisson blending and result writing. This module only
+# needs NumPy, SciPy and scikit-image, so complete.py's worker
+# processes can run `finish_round` without importing TensorFlow.
+
+from __future__ import division
+import os
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+from six.moves import xrange
+from scipy import io
+from scipy.sparse import csc_matrix
+from scipy.sparse.linalg import splu
+from scipy.special import expit
+from skimage.morphology import closing, opening, disk
+
+from utils import LRUCache, PhaseTimer, save_images, inverse_transform
+
+
+# Factorized Poisson systems, shared by every blend with the same mask.
+poisson_systems = LRUCache(32)
+
+def mask_key(mask):
+    """Identifies a blending mask by its shape and content."""
+    return mask.shape, hashlib.sha1(np.ascontiguousarray(mask != 0)).hexdigest()
+
+def poisson_system(mask, key=None):
+    """Returns the LU factorization of the Poisson system for `mask`.
+
+    Also returns the column-major indices of the masked pixels in the
+    padded image. Results are cached by `mask_key`.
+    """
+    key = key or mask_key(mask)
+    system = poisson_systems.get(key)
+    if system is None:
+        mask = np.pad(mask, (1,1), 'constant', constant_values=(0,0))
+        t_rows = mask.shape[0]
+        n = mask.size
+        m = np.reshape(mask, -1, order='F') != 0
+        inside = np.flatnonzero(m)
+        outside = np.flatnonzero(~m)
+
+        row_vec = np.concatenate([np.tile(inside, 5), outside])
+        col_vec = np.concatenate([inside, inside+1, inside-1,
+                                  inside-t_rows, inside+t_rows, outside])
+        value_vec = np.concatenate([np.full(inside.size, 4.0),
+                                    np.full(4*inside.size, -1.0),
+                                    np.ones(outside.size)])
+        A = csc_matrix((value_vec, (row_vec, col_vec)), shape=(n, n))
+        system = splu(A), inside
+        poisson_systems.put(key, system)
+    return system
+
+
+def estimate_masks(y0, x_recon0, config):
+    """Estimates the occlusion masks of a batch of images at once.
+
+    `y0` and `x_recon0` are (N, H, W, 3) arrays in [0, 255]; the
+    result is a (N, H, W) array that is 1 where the input agrees
+    with its reconstruction.
+    """
+    threshold = config.threshold
+    median_e = 0.6
+    mu_delta = 8
+
+    y = np.asarray(y0, dtype=np.float32)
+    x_recon = np.asarray(x_recon0, dtype=np.float32)
+    nImgs, h, w_, nChannels = y.shape
+
+    # Per image and channel, delta is the median_e quantile of the
+    # squared residuals; a partial sort is enough to select it.
+    residual = np.square(y-x_recon)
+    flat = np.reshape(np.transpose(residual, (0,3,1,2)), (nImgs, nChannels, -1))
+    kth = int(np.ceil(median_e*h*w_))
+    delta = np.partition(flat, kth, axis=2)[:,:,kth]
+    delta = delta[:,np.newaxis,np.newaxis,:]
+    mu = (1.0*mu_delta)/(delta + 1e-10)
+    w = expit(-mu*(residual-delta))
+
+    mk = (np.mean(w, axis=3) >= threshold).astype(np.float64)
+    #for i in range(mk.shape[0]):
+    #    mk[i] = closing(mk[i], disk(4))
+    #    mk[i] = opening(mk[i], disk(2))
+    # A flat leading axis in the footprint keeps the images apart.
+    mk = closing(mk, disk(config.closeDisk)[np.newaxis])
+    mk = opening(mk, disk(config.openDisk)[np.newaxis])
+    return mk
+
+
+def poisson_blend(source, target, mask):
+    """Poisson-blends `source` into `target` inside `mask`.
+
+    Inside the mask the result keeps the Laplacian of `source`,
+    elsewhere it equals `target`. `source` and `target` are one
+    (H, W, C) image or a (N, H, W, C) batch; `mask` is (H, W), shared
+    by the batch, or (N, H, W).
+    """
+    batched = source.ndim == 4
+    if not batched:
+        source, target = source[np.newaxis], target[np.newaxis]
+    masks = [mask]*len(source) if mask.ndim == 2 else mask
+
+    pad = ((0,0), (1,1), (1,1), (0,0))
+    source = np.pad(source, pad, 'symmetric')
+    target = np.pad(target, pad, 'symmetric')
+    nImgs, t_rows, t_cols, nChannels = source.shape
+    n = t_rows*t_cols
+
+    # Pixels are numbered column-major, so vertical neighbours are
+    # +-1 and horizontal ones +-t_rows. Every (image, channel) pair
+    # becomes one column of the right-hand side.
+    def columns(x):
+        return np.reshape(np.transpose(x, (2,1,0,3)), (n, -1))
+    s = columns(source)
+    b = columns(target).astype(np.float64)
+
+    # Images with the same mask share one factorization and are
+    # solved together.
+    groups = OrderedDict()
+    for ii in xrange(nImgs):
+        groups.setdefault(mask_key(masks[ii]), []).append(ii)
+    b = np.reshape(b, (n, nImgs, nChannels))
+    s = np.reshape(s, (n, nImgs, nChannels))
+    for key, idxs in groups.items():
+        lu, inside = poisson_system(masks[idxs[0]], key)
+        si = s[:, idxs]
+        bi = b[:, idxs]
+        bi[inside] = 4*si[inside] - si[inside-1] - si[inside+1] \
+                     - si[inside+t_rows] - si[inside-t_rows]
+        b[:, idxs] = np.reshape(lu.solve(np.reshape(bi, (n, -1))), bi.shape)
+
+    result = np.transpose(np.reshape(b, (t_cols, t_rows, nImgs, nChannels)), (2,1,0,3))
+    result = result[:, 1:t_rows-1, 1:t_cols-1, :]
+    return result if batched else result[0]
+
+
+def finish_round(config, jobs, writer=None):
+    """Ends the current mask round of `jobs`; returns them with the
+    timing records of the round.
+
+    This runs in a worker process while the session optimizes other
+    images. Jobs on their last round have
+    their completion written to `results/`, through `writer` if given,
+    or stored as `job['completed']` for the archive or the request
+    they answer; the others get an updated mask and are reset to start
+    the next round. The caller writes the timings, so that worker
+    processes do not append to the timings file themselves.
+    """
+    save = writer.save_images if writer is not None else save_images
+    timer = PhaseTimer(keep=True)
+    if config.maskIter != 0:
+        with timer.phase('calc_mask', n=len(jobs)):
+            masks = estimate_masks(255*inverse_transform(np.array([job['image'] for job in jobs])),
+                                   255*inverse_transform(np.array([job['G'] for job in jobs])),
+                                   config)
+    for ii, job in enumerate(jobs):
+        name = job['name']
+        if config.maskIter != 0:
+            mask = np.repeat(masks[ii][:,:,np.newaxis], 3, axis=2)
+            if config.snapshots > 0:
+                maskMat = os.path.join(config.outDir, 'mask/{}_{:02d}.mat'.format(
+                    name, job['round']))
+                io.savemat(maskMat, mdict = {'mask' : masks[ii]})
+                maskName = os.path.join(config.outDir, 'mask/{}_{:02d}.png'.format(
+                    name, job['round']))
+                save(mask[np.newaxis], [1, 1], maskName)
+
+        job['round'] += 1
+        if job['round'] < max(config.maskIter, 1):
+            job.update(mask=mask, iter=0, best=np.inf, bestIter=0)
+            print("%s: mask round %d after loss %.4f" % (name, job['round'], job['loss']))
+
+    final = [job for job in jobs if job['round'] >= max(config.maskIter, 1)]
+    if final:
+        images = np.array([job['image'] for job in final])
+        masks = np.array([job['mask'] for job in final])
+        G_imgs = np.array([job['G'] for job in final])
+        if config.blend:
+            # Jobs sharing a mask reuse one cached factorization.
+            with timer.phase('blending', n=len(final)):
+                completeed = np.clip(poisson_blend(G_imgs, images, 1.0-masks[:,:,:,0]), -1, 1)
+        else:
+            completeed = np.multiply(images, masks) + np.multiply(G_imgs, 1.0-masks)
+        with timer.phase('save_images', n=len(final)):
+            for job, img in zip(final, completeed):
+                if config.archive or 'request' in job:
+                    # The main process hands these to the archive or request.
+                    job['completed'] = img
+                    del job['G']
+                else:
+                    save(img[np.newaxis], [1, 1],
+                         os.path.join(config.outDir, 'results', job['name'] + '.png'))
+    timer.close(totals=False)
+    return jobs, timer.records
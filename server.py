@@ -0,0 +1,141 @@
+# HTTP front end of `complete.py --serve`. Requests are decoded on the
+# server's threads and put on a queue that `DCGAN.serve` takes them
+# from; each thread waits for its own completion and sends it back.
+
+import io
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import urlparse, parse_qs
+
+from utils import transform, inverse_transform
+
+
+class CompletionRequest(object):
+    """One image with its mask, waiting for its completion."""
+    def __init__(self, image, mask):
+        self.image = image
+        self.mask = mask
+        self.job = None
+        self.done = threading.Event()
+
+    def finish(self, job):
+        self.job = job
+        self.done.set()
+
+    def wait(self):
+        # Waiting in short steps keeps the thread responsive to Ctrl-C on Python 2.
+        while not self.done.wait(1.0):
+            pass
+        return self.job
+
+
+class CompletionHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Completes the image POSTed to /complete.
+
+    The body is either an image file with the mask type in the query
+    string (`/complete?maskType=center`), or an .npz file with a uint8
+    `image` array and optionally a `mask` array that is 1 for known
+    pixels. The response is the completed image as a PNG, with the
+    final loss in the X-Completion-Loss header.
+
+    A POST to /shutdown makes `DCGAN.serve` return once the requests
+    it has taken are done.
+    """
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path == '/shutdown':
+            self.server.requests.put(None)
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if url.path != '/complete':
+            self.send_error(404)
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        query = parse_qs(url.query)
+        try:
+            image, mask = self.decode(body, query.get('maskType', [None])[0])
+        except (IOError, EOFError, ValueError, KeyError, AssertionError) as e:
+            self.send_error(400, str(e))
+            return
+
+        request = CompletionRequest(image, mask)
+        self.server.requests.put(request)
+        job = request.wait()
+
+        out = io.BytesIO()
+        completed = np.round(255*inverse_transform(job['completed']))
+        Image.fromarray(np.clip(completed, 0, 255).astype(np.uint8)).save(out, 'PNG')
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(out.getvalue())))
+        self.send_header('X-Completion-Loss', '%.6f' % job['loss'])
+        self.end_headers()
+        self.wfile.write(out.getvalue())
+
+    def decode(self, body, maskType):
+        """Returns the image in [-1, 1] and its three-channel mask."""
+        shape = tuple(self.server.dcgan.image_shape)
+        mask = None
+        if self.headers.get('Content-Type', '').startswith('image/'):
+            image = np.array(Image.open(io.BytesIO(body)).convert('RGB'))
+        else:
+            arrays = np.load(io.BytesIO(body), allow_pickle=False)
+            image = arrays['image']
+            if 'mask' in arrays.files:
+                mask = np.asarray(arrays['mask'], dtype=np.float64)
+                if mask.ndim == 2:
+                    mask = np.repeat(mask[:,:,np.newaxis], 3, axis=2)
+        if image.shape != shape:
+            raise ValueError('expected a %dx%dx%d image' % shape)
+        if mask is None:
+            mask = self.server.dcgan.make_mask(maskType or self.server.maskType)
+        elif mask.shape != shape:
+            raise ValueError('the mask does not match the image')
+        return transform(image, is_crop=False).astype(np.float32), mask
+
+    def address_string(self):
+        # Unix sockets have no client address.
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+
+class HTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def start_server(address, dcgan, requests, maskType='center'):
+    """Serves completions on `address` from a background thread.
+
+    `address` is `host:port`, or `unix:PATH` for a unix socket.
+    Requests are put on `requests` for `dcgan.serve`.
+    """
+    if address.startswith('unix:'):
+        server = UnixHTTPServer(address[len('unix:'):], CompletionHandler)
+    else:
+        host, port = address.rsplit(':', 1)
+        server = HTTPServer((host, int(port)), CompletionHandler)
+    server.dcgan = dcgan
+    server.requests = requests
+    server.maskType = maskType
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
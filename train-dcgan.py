@@ -11,7 +11,7 @@ import scipy.misc
 import numpy as np
 
 from model import DCGAN
-from utils import pp, visualize, to_json
+from utils import pp, visualize, export_weights
 
 import tensorflow as tf
 
@@ -23,8 +23,24 @@ flags.DEFINE_integer("train_size", np.inf, "The size of train images [np.inf]")
 flags.DEFINE_integer("batch_size", 64, "The size of batch images [64]")
 flags.DEFINE_integer("image_size", 64, "The size of image to use")
 flags.DEFINE_string("dataset", "lfw-aligned-64", "Dataset directory.")
+flags.DEFINE_string("dataset_cache", None, "Dataset written by ingest-images.py, used instead of --dataset")
 flags.DEFINE_string("checkpoint_dir", "checkpoint", "Directory name to save the checkpoints [checkpoint]")
 flags.DEFINE_string("sample_dir", "samples", "Directory name to save the image samples [samples]")
+flags.DEFINE_integer("prefetch", 8, "Number of decoded batches to keep ready [8]")
+flags.DEFINE_integer("loaders", 4, "Number of image decoding threads [4]")
+flags.DEFINE_integer("d_steps", 1, "Discriminator updates per training step [1]")
+flags.DEFINE_integer("g_steps", 2, "Generator updates per training step [2]")
+flags.DEFINE_integer("log_interval", 1, "Steps between loss printouts and summaries [1]")
+flags.DEFINE_string("timings", None, "File to append per-phase timings to, as JSON lines")
+flags.DEFINE_string("trace_steps", "", "Comma separated steps to capture a TensorFlow trace for")
+flags.DEFINE_string("trace_dir", "logs", "Directory for the TensorFlow traces [logs]")
+flags.DEFINE_integer("sample_interval", 100, "Steps between sample sheets, 0 disables them [100]")
+flags.DEFINE_integer("checkpoint_interval", 500, "Steps between checkpoints, 0 disables them [500]")
+flags.DEFINE_integer("keep_checkpoints", 3, "Number of recent checkpoints to keep [3]")
+flags.DEFINE_integer("milestone_interval", 10000, "Also keep the first checkpoint of every this many steps, 0 disables [10000]")
+flags.DEFINE_string("export_weights", None, "Write the generator weights of the checkpoint to this file instead of training")
+flags.DEFINE_string("export_dtype", "float32", "Type of the exported weights, float32 or float16 [float32]")
+flags.DEFINE_string("devices", "", "Comma separated devices to split every batch across, e.g. /cpu:0,/cpu:1")
 FLAGS = flags.FLAGS
 
 if not os.path.exists(FLAGS.checkpoint_dir):
@@ -32,10 +48,28 @@ if not os.path.exists(FLAGS.checkpoint_dir):
 if not os.path.exists(FLAGS.sample_dir):
     os.makedirs(FLAGS.sample_dir)
 
-config = tf.ConfigProto()
+devices = [d for d in FLAGS.devices.split(',') if d]
+# TensorFlow only creates one CPU device unless asked for more. These
+# devices share the process's intra-op thread pool, so CPU towers only
+# add inter-op parallelism; measure with benchmark-dcgan.py --trainTowers.
+cpus = [int(d.rsplit(':', 1)[1]) for d in devices if d.lower().startswith('/cpu:')]
+config = tf.ConfigProto(device_count={'CPU': max(cpus) + 1} if cpus else None,
+                        allow_soft_placement=True)
 config.gpu_options.allow_growth = True
 with tf.Session(config=config) as sess:
     dcgan = DCGAN(sess, image_size=FLAGS.image_size, batch_size=FLAGS.batch_size,
-                  is_crop=False, checkpoint_dir=FLAGS.checkpoint_dir)
+                  is_crop=False, checkpoint_dir=FLAGS.checkpoint_dir,
+                  devices=devices)
 
-    dcgan.train(FLAGS)
+    if FLAGS.export_weights:
+        isLoaded = dcgan.load(FLAGS.checkpoint_dir)
+        assert(isLoaded)
+        export_weights(FLAGS.export_weights,
+                       [dcgan.h0_w, dcgan.h0_b, dcgan.g_bn0],
+                       [dcgan.h1_w, dcgan.h1_b, dcgan.g_bn1],
+                       [dcgan.h2_w, dcgan.h2_b, dcgan.g_bn2],
+                       [dcgan.h3_w, dcgan.h3_b, dcgan.g_bn3],
+                       [dcgan.h4_w, dcgan.h4_b, None],
+                       dtype=FLAGS.export_dtype)
+    else:
+        dcgan.train(FLAGS)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3.4
+#
+# Trains the encoder that gives complete.py a starting z for every
+# image, against the generator of an already trained DCGAN checkpoint.
+# The checkpoint itself is not modified; the encoder is saved to
+# --encoder_dir and used with `complete.py --encoderDir`.
+
+import os
+import numpy as np
+
+from model import DCGAN
+
+import tensorflow as tf
+
+flags = tf.app.flags
+flags.DEFINE_integer("steps", 20000, "Training steps [20000]")
+flags.DEFINE_float("learning_rate", 0.0002, "Learning rate of for adam [0.0002]")
+flags.DEFINE_float("beta1", 0.5, "Momentum term of adam [0.5]")
+flags.DEFINE_integer("batch_size", 64, "The size of batch images [64]")
+flags.DEFINE_integer("image_size", 64, "The size of image to use")
+flags.DEFINE_string("checkpoint_dir", "checkpoint", "Directory of the trained DCGAN [checkpoint]")
+flags.DEFINE_string("encoder_dir", "encoder", "Directory name to save the encoder checkpoints [encoder]")
+flags.DEFINE_string("mask_types", "center,left,random,Eye,Scarf", "Comma separated mask types to train on")
+flags.DEFINE_float("context_weight", 0.01, "Weight of the contextual loss of the reconstruction [0.01]")
+flags.DEFINE_integer("log_interval", 100, "Steps between loss printouts [100]")
+flags.DEFINE_integer("save_interval", 1000, "Steps between encoder checkpoints [1000]")
+FLAGS = flags.FLAGS
+
+assert(os.path.exists(FLAGS.checkpoint_dir))
+
+config = tf.ConfigProto()
+config.gpu_options.allow_growth = True
+with tf.Session(config=config) as sess:
+    dcgan = DCGAN(sess, image_size=FLAGS.image_size, batch_size=FLAGS.batch_size,
+                  is_crop=False, checkpoint_dir=FLAGS.checkpoint_dir, mode='complete',
+                  encoder=True)
+
+    dcgan.train_encoder(FLAGS)
@@ -6,12 +6,20 @@
 Some codes from https://github.com/Newmu/dcgan_code
 """
 from __future__ import division
+import os
 import math
 import json
+import hashlib
 import random
+import time
 import pprint
+import threading
 import scipy.misc
 import numpy as np
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from six.moves import queue
 from time import gmtime, strftime
 
 pp = pprint.PrettyPrinter()
@@ -63,69 +71,484 @@ def transform(image, npx=64, is_crop=True):
 def inverse_transform(images):
     return (images+1.)/2.
 
-
-def to_json(output_path, *layers):
-    with open(output_path, "w") as layer_f:
-        lines = ""
+def ingest_images(files, path, image_size=64, is_crop=True):
+    """Decodes `files` once into a memory-mapped dataset at `path`.
+
+    The cropped images are stored as uint8 in `path.npy`, and the
+    absolute source paths in `path.json`. Use `ImageCache` to read them.
+    """
+    path = os.path.splitext(path)[0]
+    images = np.lib.format.open_memmap(path + '.npy', mode='w+', dtype=np.uint8,
+                                       shape=(len(files), image_size, image_size, 3))
+    for i, image_file in enumerate(files):
+        image = imread(image_file)
+        images[i] = center_crop(image, image_size) if is_crop else image
+    images.flush()
+    with open(path + '.json', 'w') as f:
+        json.dump({'files': [os.path.abspath(image_file) for image_file in files],
+                   'image_size': image_size, 'is_crop': is_crop}, f)
+
+class ImageCache(object):
+    """Read-only view of a dataset written by `ingest_images`.
+
+    Batches are sliced straight out of the page cache, so reading them
+    decodes nothing and concurrent jobs share the same memory.
+    """
+    def __init__(self, path):
+        path = os.path.splitext(path)[0]
+        self.images = np.load(path + '.npy', mmap_mode='r')
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        self.files = meta['files']
+        self.image_size = meta['image_size']
+        self.is_crop = meta['is_crop']
+        self.index = dict((image_file, i) for i, image_file in enumerate(self.files))
+
+    def __len__(self):
+        return len(self.files)
+
+    def load(self, key):
+        """Returns the images at `key`, a slice or index array, in [-1, 1]."""
+        return self.images[key].astype(np.float32)/127.5 - 1.
+
+    def lookup(self, files):
+        """Returns the indices of `files`, with None for those it does not hold."""
+        return [self.index.get(os.path.abspath(image_file)) for image_file in files]
+
+
+def prefetch(iterable, size=2):
+    """Iterates over `iterable` on a background thread.
+
+    Up to `size` items are produced ahead of the consumer, so decoding
+    the next batch overlaps with work on the current one while memory
+    stays bounded.
+    """
+    q = queue.Queue(maxsize=size)
+    end = object()
+
+    def worker():
+        try:
+            for item in iterable:
+                q.put((item, None))
+        except Exception as e:
+            q.put((None, e))
+        q.put((end, None))
+
+    t = threading.Thread(target=worker)
+    t.daemon = True
+    t.start()
+    while True:
+        item, err = q.get()
+        if err is not None:
+            raise err
+        if item is end:
+            break
+        yield item
+
+
+class Prefetcher(object):
+    """Applies `fn` to the items of `iterable` on a pool of threads.
+
+    At most `size` results are queued ahead of the consumer. Iterating
+    yields the results in input order; `occupancy()` reports how many
+    of them are already waiting.
+    """
+    def __init__(self, fn, iterable, size=4, nThreads=4):
+        self.size = size
+        self.pool = ThreadPool(nThreads)
+        self.queue = queue.Queue(maxsize=size)
+
+        def feed():
+            for item in iterable:
+                self.queue.put(self.pool.apply_async(fn, (item,)))
+            self.queue.put(None)
+
+        t = threading.Thread(target=feed)
+        t.daemon = True
+        t.start()
+
+    def __iter__(self):
+        while True:
+            result = self.queue.get()
+            if result is None:
+                break
+            yield result.get()
+        self.pool.close()
+
+    def occupancy(self):
+        return sum(1 for result in list(self.queue.queue)
+                   if result is not None and result.ready())
+
+
+class ImageWriter(object):
+    """Saves image grids on background threads.
+
+    `save_images` queues a copy of the images and returns; at most `size`
+    grids wait in the queue. `flush` blocks until everything queued has
+    been written and re-raises the first error a writer hit.
+    """
+    def __init__(self, size=16, nThreads=1):
+        self.queue = queue.Queue(maxsize=size)
+        self.error = None
+        for _ in range(nThreads):
+            t = threading.Thread(target=self.work)
+            t.daemon = True
+            t.start()
+
+    def work(self):
+        while True:
+            images, size, image_path = self.queue.get()
+            try:
+                save_images(images, size, image_path)
+            except Exception as e:
+                self.error = self.error or e
+            finally:
+                self.queue.task_done()
+
+    def save_images(self, images, size, image_path):
+        self.queue.put((np.array(images), size, image_path))
+
+    def flush(self):
+        self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+class BackgroundWorker(object):
+    """Runs functions on a background thread, one after the other.
+
+    `wait` blocks until everything queued has run, re-raises the first
+    error one of them hit, and returns what the others returned since
+    the last `wait`.
+    """
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.error = None
+        self.results = []
+        t = threading.Thread(target=self.work)
+        t.daemon = True
+        t.start()
+
+    def work(self):
+        while True:
+            fn, args = self.queue.get()
+            try:
+                self.results.append(fn(*args))
+            except Exception as e:
+                self.error = self.error or e
+            finally:
+                self.queue.task_done()
+
+    def run(self, fn, *args):
+        self.queue.put((fn, args))
+
+    def wait(self):
+        self.queue.join()
+        results, self.results = self.results, []
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        return results
+
+
+class PhaseTimer(object):
+    """Records the wall time of named phases as JSON lines.
+
+    Every finished phase is appended to `path` as one JSON object, and
+    kept in `records` if `keep`. Session runs made through `run` at one
+    of `trace_steps` also write a full TensorFlow trace, in Chrome trace
+    format, to `trace_dir`.
+    """
+    def __init__(self, path=None, trace_steps=(), trace_dir='.', keep=False):
+        self.out = open(path, 'a') if path else None
+        self.records = [] if keep else None
+        self.trace_steps = set(trace_steps)
+        self.trace_dir = trace_dir
+        self.totals = {}
+
+    @contextmanager
+    def phase(self, name, **fields):
+        start = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            self.totals[name] = self.totals.get(name, 0.0) + seconds
+            self.record(phase=name, start=start, seconds=seconds, **fields)
+
+    def record(self, **fields):
+        if self.records is not None:
+            self.records.append(fields)
+        if self.out is not None:
+            self.out.write(json.dumps(fields) + '\n')
+            self.out.flush()
+
+    def iterate(self, iterable, name):
+        """Yields from `iterable`, timing each wait as phase `name`."""
+        it = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def run(self, sess, fetches, feed_dict, name, step, part=None):
+        """Runs `fetches` in `sess`, traced if `step` is a trace step.
+
+        `part` numbers the runs of one step that share a `name`, so
+        that each gets its own trace.
+        """
+        if step not in self.trace_steps:
+            return sess.run(fetches, feed_dict=feed_dict)
+
+        import tensorflow as tf
+        from tensorflow.python.client import timeline
+        run_metadata = tf.RunMetadata()
+        results = sess.run(fetches, feed_dict=feed_dict,
+                           options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                           run_metadata=run_metadata)
+        suffix = '' if part is None else '_{}'.format(part)
+        trace = os.path.join(self.trace_dir,
+                             '{}_{:06d}{}.trace.json'.format(name, step, suffix))
+        with open(trace, 'w') as f:
+            f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+        if part is None:
+            self.record(phase=name, step=step, trace=trace)
+        else:
+            self.record(phase=name, step=step, part=part, trace=trace)
+        return results
+
+    def close(self, totals=True):
+        """Writes the total time of every phase, unless `totals` is False."""
+        if totals:
+            self.record(totals=self.totals)
+        if self.out is not None:
+            self.out.close()
+
+
+def parse_steps(steps):
+    """Parses a comma separated list of step numbers."""
+    return [int(step) for step in steps.split(',') if step] if steps else []
+
+
+def result_dtype(image_shape, z_dim):
+    """Layout of one record of a `ResultArchive`."""
+    return np.dtype([('image', np.uint8, tuple(image_shape)),
+                     ('mask', np.uint8, tuple(image_shape[:2])),
+                     ('z', '<f4', (z_dim,)),
+                     ('loss', '<f4')])
+
+class ResultArchive(object):
+    """Appends per-image completion results to one binary file.
+
+    Every record holds the completed image and its mask as uint8, the
+    optimized z as float32 and the final loss. Records are written to
+    `path.bin` in chunks of `chunk`; `path.json` describes the layout and
+    maps each input file to its record, and is written by `close`. A file
+    that is appended again gets a new record, which the index then points
+    to. Read them with `open_results`.
+    """
+    def __init__(self, path, image_shape, z_dim, chunk=64):
+        self.path = os.path.splitext(path)[0]
+        self.image_shape = list(image_shape)
+        self.z_dim = z_dim
+        self.dtype = result_dtype(image_shape, z_dim)
+        self.chunk = chunk
+        self.data = open(self.path + '.bin', 'wb')
+        self.buffer = []
+        self.count = 0
+        self.files = {}
+
+    def append(self, image_file, image, mask, z, loss):
+        """Adds one result; `image` is in [-1, 1] and `mask` is (H, W)."""
+        record = np.zeros((), self.dtype)
+        record['image'] = np.clip(np.round(inverse_transform(image)*255), 0, 255)
+        record['mask'] = np.asarray(mask) != 0
+        record['z'] = z
+        record['loss'] = loss
+        self.files[image_file] = self.count
+        self.count += 1
+        self.buffer.append(record)
+        if len(self.buffer) >= self.chunk:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            np.array(self.buffer, dtype=self.dtype).tofile(self.data)
+            self.data.flush()
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.data.close()
+        index = {'image_shape': self.image_shape, 'z_dim': self.z_dim,
+                 'count': self.count, 'files': self.files}
+        with open(self.path + '.json.tmp', 'w') as f:
+            json.dump(index, f)
+        os.rename(self.path + '.json.tmp', self.path + '.json')
+
+def open_results(path):
+    """Returns the memory-mapped records of a `ResultArchive` and its file index."""
+    path = os.path.splitext(path)[0]
+    with open(path + '.json') as f:
+        index = json.load(f)
+    dtype = result_dtype(index['image_shape'], index['z_dim'])
+    records = np.memmap(path + '.bin', dtype=dtype, mode='r', shape=(index['count'],))
+    return records, index['files']
+
+
+def image_key(image):
+    """Identifies an image by its content."""
+    return hashlib.sha1(np.ascontiguousarray(image)).hexdigest()
+
+def checkpoint_id(path):
+    """Identifies a checkpoint by its name, size and modification time."""
+    for p in [path, path + '.index']:
+        if os.path.exists(p):
+            st = os.stat(p)
+            return '%s-%d-%d' % (os.path.basename(path), st.st_size, int(st.st_mtime))
+    return os.path.basename(path)
+
+class LatentCache(object):
+    """Optimized latent codes on disk, keyed by image and checkpoint.
+
+    Every entry is a small .npy file in `path`. Reading an entry marks it
+    as recently used, and the least recently used entries are removed
+    once there are more than `maxsize` of them.
+    """
+    def __init__(self, path, checkpoint, maxsize=100000):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.checkpoint = checkpoint
+        self.maxsize = maxsize
+        self.size = len(os.listdir(path))
+
+    def filename(self, key):
+        name = hashlib.sha1((self.checkpoint + '/' + key).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, name + '.npy')
+
+    def get(self, key):
+        filename = self.filename(key)
+        try:
+            z = np.load(filename)
+            os.utime(filename, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return z
+
+    def put(self, key, z):
+        filename = self.filename(key)
+        if not os.path.exists(filename):
+            self.size += 1
+        with open(filename + '.tmp', 'wb') as f:
+            np.save(f, np.asarray(z, dtype=np.float32))
+        os.rename(filename + '.tmp', filename)
+        if self.size > self.maxsize:
+            self.evict()
+
+    def evict(self):
+        """Removes the oldest entries, down to 90% of `maxsize`."""
+        entries = [os.path.join(self.path, name) for name in os.listdir(self.path)
+                   if name.endswith('.npy')]
+        entries.sort(key=os.path.getmtime)
+        nRemove = max(len(entries) - int(0.9*self.maxsize), 0)
+        for filename in entries[:nRemove]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        self.size = len(entries) - nRemove
+
+
+class LRUCache(object):
+    """A bounded mapping that evicts the least recently used entry."""
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self.data:
+            return default
+        value = self.data.pop(key)
+        self.data[key] = value
+        return value
+
+    def put(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+
+def export_weights(output_path, *layers, **kwargs):
+    """Writes the weights of `layers` as raw little-endian floats.
+
+    Every layer is a `[w, b, bn]` list like `[dcgan.h0_w, dcgan.h0_b, dcgan.g_bn0]`,
+    with `bn` None for layers without batch norm. The filters, biases
+    and batch norm gamma and beta of each layer are evaluated and
+    written one at a time to `output_path`, as `dtype` ('float32' or
+    'float16'). `output_path + '.json'` lists every layer with the
+    shape and byte offset of each of its arrays; see `open_weights`.
+    Filters are laid out as [out, in] for fully connected layers and
+    [out, height, width, in] for deconvolutions.
+    """
+    dtype = np.dtype(kwargs.get('dtype', 'float32')).newbyteorder('<')
+    manifest = {'format': 1, 'dtype': dtype.name, 'byteorder': 'little',
+                'data': os.path.basename(output_path), 'layers': []}
+    offset = 0
+    with open(output_path, 'wb') as f:
         for w, b, bn in layers:
             layer_idx = w.name.split('/')[0].split('h')[1]
-
-            B = b.eval()
-
             if "lin/" in w.name:
-                W = w.eval()
-                depth = W.shape[1]
+                W = w.eval().T
+                layer = {'name': 'layer_%s' % layer_idx.split('_')[0], 'layer_type': 'fc',
+                         'sy': 1, 'sx': 1, 'out_sx': 1, 'out_sy': 1, 'stride': 1, 'pad': 0,
+                         'out_depth': W.shape[0], 'in_depth': W.shape[1]}
             else:
                 W = np.rollaxis(w.eval(), 2, 0)
-                depth = W.shape[0]
-
-            biases = {"sy": 1, "sx": 1, "depth": depth, "w": ['%.2f' % elem for elem in list(B)]}
-            if bn != None:
-                gamma = bn.gamma.eval()
-                beta = bn.beta.eval()
-
-                gamma = {"sy": 1, "sx": 1, "depth": depth, "w": ['%.2f' % elem for elem in list(gamma)]}
-                beta = {"sy": 1, "sx": 1, "depth": depth, "w": ['%.2f' % elem for elem in list(beta)]}
-            else:
-                gamma = {"sy": 1, "sx": 1, "depth": 0, "w": []}
-                beta = {"sy": 1, "sx": 1, "depth": 0, "w": []}
-
-            if "lin/" in w.name:
-                fs = []
-                for w in W.T:
-                    fs.append({"sy": 1, "sx": 1, "depth": W.shape[0], "w": ['%.2f' % elem for elem in list(w)]})
-
-                lines += """
-                    var layer_%s = {
-                        "layer_type": "fc",
-                        "sy": 1, "sx": 1,
-                        "out_sx": 1, "out_sy": 1,
-                        "stride": 1, "pad": 0,
-                        "out_depth": %s, "in_depth": %s,
-                        "biases": %s,
-                        "gamma": %s,
-                        "beta": %s,
-                        "filters": %s
-                    };""" % (layer_idx.split('_')[0], W.shape[1], W.shape[0], biases, gamma, beta, fs)
-            else:
-                fs = []
-                for w_ in W:
-                    fs.append({"sy": 5, "sx": 5, "depth": W.shape[3], "w": ['%.2f' % elem for elem in list(w_.flatten())]})
-
-                lines += """
-                    var layer_%s = {
-                        "layer_type": "deconv",
-                        "sy": 5, "sx": 5,
-                        "out_sx": %s, "out_sy": %s,
-                        "stride": 2, "pad": 1,
-                        "out_depth": %s, "in_depth": %s,
-                        "biases": %s,
-                        "gamma": %s,
-                        "beta": %s,
-                        "filters": %s
-                    };""" % (layer_idx, 2**(int(layer_idx)+2), 2**(int(layer_idx)+2),
-                             W.shape[0], W.shape[3], biases, gamma, beta, fs)
-        layer_f.write(" ".join(lines.replace("'","").split()))
+                out_size = 2**(int(layer_idx)+2)
+                layer = {'name': 'layer_%s' % layer_idx, 'layer_type': 'deconv',
+                         'sy': 5, 'sx': 5, 'out_sx': out_size, 'out_sy': out_size,
+                         'stride': 2, 'pad': 1,
+                         'out_depth': W.shape[0], 'in_depth': W.shape[3]}
+            arrays = [('filters', W), ('biases', b.eval())]
+            if bn is not None:
+                arrays += [('gamma', bn.gamma.eval()), ('beta', bn.beta.eval())]
+            layer['arrays'] = {}
+            for name, array in arrays:
+                data = np.ascontiguousarray(array, dtype=dtype)
+                # Arrays start at 64-byte boundaries.
+                padding = -offset % 64
+                f.write(b'\0'*padding)
+                offset += padding
+                layer['arrays'][name] = {'shape': list(data.shape), 'offset': offset}
+                f.write(data.tobytes())
+                offset += data.nbytes
+            manifest['layers'].append(layer)
+
+    with open(output_path + '.json', 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+def open_weights(manifest_path):
+    """Memory-maps the weights written by `export_weights`.
+
+    Returns the layers of the manifest, with each of their arrays
+    mapped from the data file next to it.
+    """
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    data = os.path.join(os.path.dirname(manifest_path), manifest['data'])
+    dtype = np.dtype(manifest['dtype']).newbyteorder('<')
+    for layer in manifest['layers']:
+        for name, array in layer['arrays'].items():
+            layer['arrays'][name] = np.memmap(data, dtype=dtype, mode='r',
+                                              offset=array['offset'],
+                                              shape=tuple(array['shape']))
+    return manifest['layers']
 
 def make_gif(images, fname, duration=2, true_image=False):
   import moviepy.editor as mpy